@@ -0,0 +1,67 @@
+"""
+Micro-benchmark: waking N contexts waiting on one future.
+
+Each run creates N waiters, parks them all on a shared future, then sets its result once.
+
+Usage::
+
+    $ python benchmarks/bench_fan_out.py [repeats]
+"""
+import sys
+import time
+
+import vanstein
+from vanstein.decorators import async_func
+
+vanstein.hijack()
+
+from vanstein.futures import Future
+from vanstein.loop import BaseAsyncLoop
+
+FAN_OUTS = (1, 10, 100, 1000, 10000)
+
+
+@async_func
+def waiter(fut):
+    return fut.wait()
+
+
+def bench(waiters: int) -> float:
+    """
+    Wakes a number of waiters with one result.
+
+    :return: The number of seconds taken, from setting the result to every waiter finishing.
+    """
+    loop = BaseAsyncLoop()
+    fut = Future()
+    contexts = [waiter(fut) for _ in range(waiters)]
+
+    # Park every waiter first, so that only the fan-out itself is timed.
+    start = None
+
+    def fill():
+        nonlocal start
+        start = time.perf_counter()
+        fut.set_result(42)
+
+    loop.call_later(0, fill)
+    results = loop.run_until_complete(*contexts)
+    elapsed = time.perf_counter() - start
+    loop.close()
+
+    assert results == [42] * waiters
+    return elapsed
+
+
+def main(argv: list):
+    repeats = int(argv[1]) if len(argv) > 1 else 5
+    # Warm up, so that the code is compiled before timing.
+    bench(10)
+
+    for waiters in FAN_OUTS:
+        best = min(bench(waiters) for _ in range(repeats))
+        print("{:>6} waiters: {:8.3f} ms, {:,.0f} wakeups/sec".format(waiters, best * 1000, waiters / best))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
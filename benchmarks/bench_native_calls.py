@@ -0,0 +1,77 @@
+"""
+Micro-benchmark: calls/sec for builtin-heavy VS code.
+
+Every call made by `builtin_heavy` goes through the native call path of CALL_FUNCTION.
+
+Usage::
+
+    $ python benchmarks/bench_native_calls.py [runs]
+"""
+import sys
+import time
+
+import vanstein
+from vanstein.decorators import async_func
+
+vanstein.hijack()
+
+from vanstein.loop import BaseAsyncLoop
+
+# The number of native calls made by one run of `builtin_heavy`.
+CALLS_PER_RUN = 20
+
+
+@async_func
+def builtin_heavy(x, y):
+    len(x)
+    abs(y)
+    min(x)
+    max(x)
+    len(x)
+    abs(y)
+    min(x)
+    max(x)
+    isinstance(x, tuple)
+    hash(y)
+    len(x)
+    abs(y)
+    min(x)
+    max(x)
+    len(x)
+    abs(y)
+    min(x)
+    max(x)
+    isinstance(x, tuple)
+    return hash(y)
+
+
+def bench(runs: int) -> float:
+    """
+    Runs `builtin_heavy` a number of times.
+
+    :return: The number of native calls made per second.
+    """
+    loop = BaseAsyncLoop()
+    args = ((1, 2, 3), -4)
+
+    start = time.perf_counter()
+    for _ in range(runs):
+        loop.run(builtin_heavy(*args))
+    elapsed = time.perf_counter() - start
+    loop.close()
+
+    return (runs * CALLS_PER_RUN) / elapsed
+
+
+def main(argv: list):
+    runs = int(argv[1]) if len(argv) > 1 else 20000
+    # Warm up, so that the code is compiled before timing.
+    bench(100)
+
+    # Take the best of a few repeats, to cut down on noise.
+    best = max(bench(runs) for _ in range(5))
+    print("native calls/sec: {:,.0f}".format(best))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,59 @@
+"""
+Benchmark: CPU-bound VS calls on one loop, compared to a sharded loop.
+
+Usage::
+
+    $ python benchmarks/bench_sharded.py [calls] [shards]
+"""
+import os
+import sys
+import time
+
+import vanstein
+from vanstein.decorators import async_func
+
+vanstein.hijack()
+
+from vanstein.loop import BaseAsyncLoop
+from vanstein.sharding import ShardedLoop
+
+
+@async_func
+def crunch(n):
+    total = 0
+    for i in range(n):
+        total += i * i
+    return total
+
+
+def bench_single(calls: int, n: int) -> float:
+    loop = BaseAsyncLoop()
+    start = time.perf_counter()
+    loop.run_until_complete(*[crunch(n) for _ in range(calls)])
+    elapsed = time.perf_counter() - start
+    loop.close()
+
+    return calls / elapsed
+
+
+def bench_sharded(calls: int, n: int, shards: int) -> float:
+    with ShardedLoop(shards) as loop:
+        # Warm up every shard, so that process start-up isn't timed.
+        loop.gather(*[loop.submit(crunch, 10) for _ in range(shards)])
+
+        start = time.perf_counter()
+        loop.gather(*[loop.submit(crunch, n) for _ in range(calls)])
+        return calls / (time.perf_counter() - start)
+
+
+def main(argv: list):
+    calls = int(argv[1]) if len(argv) > 1 else 200
+    shards = int(argv[2]) if len(argv) > 2 else os.cpu_count()
+    n = 10000
+
+    print("single loop: {:,.1f} calls/sec".format(bench_single(calls, n)))
+    print("{} shards:   {:,.1f} calls/sec".format(shards, bench_sharded(calls, n, shards)))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
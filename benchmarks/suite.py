@@ -0,0 +1,277 @@
+"""
+Benchmark suite: Vanstein compared to plain CPython and asyncio.
+
+Each benchmark runs the same work three ways: as plain CPython, inside Vanstein, and as asyncio coroutines. Results
+are reported as throughput, along with how many times slower Vanstein is than each of the others.
+
+Usage::
+
+    $ python benchmarks/suite.py [--repeat N] [--quick] [--json results.json] [benchmark ...]
+"""
+import argparse
+import asyncio
+import collections
+import gc
+import json
+import sys
+import time
+import tracemalloc
+
+import vanstein
+from vanstein.decorators import async_func
+
+vanstein.hijack()
+
+from vanstein.loop import BaseAsyncLoop
+
+# A global, for the global load benchmark.
+GLOBAL_VALUE = 1
+
+
+# The workloads.
+# The plain functions are ran directly by CPython, and wrapped with `async_func` to run inside Vanstein.
+
+def loop_range(n):
+    for i in range(n):
+        pass
+
+
+def arithmetic(n):
+    total = 0
+    for i in range(n):
+        total += i * 3 - i // 2
+    return total
+
+
+def global_loads(n):
+    total = 0
+    for i in range(n):
+        total = total + GLOBAL_VALUE + GLOBAL_VALUE + GLOBAL_VALUE
+    return total
+
+
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+
+def raise_catch(n):
+    caught = 0
+    for i in range(n):
+        try:
+            raise ValueError(i)
+        except ValueError:
+            caught += 1
+    return caught
+
+
+def task(n):
+    return n + 1
+
+
+# The asyncio versions.
+
+async def aio_fib(n):
+    if n < 2:
+        return n
+    return await aio_fib(n - 1) + await aio_fib(n - 2)
+
+
+async def aio_task(n):
+    return n + 1
+
+
+def _coroutine(func):
+    # The asyncio version of a workload that doesn't wait on anything is just a coroutine that runs it.
+    async def wrapper(*args):
+        return func(*args)
+
+    return wrapper
+
+
+# name -> (plain function, asyncio coroutine function, argument, operations per run, quick argument, quick operations)
+Workload = collections.namedtuple("Workload", "func aio arg ops quick_arg quick_ops")
+
+# fib(n) makes fib(n + 1) * 2 - 1 calls.
+WORKLOADS = collections.OrderedDict([
+    ("loop_range", Workload(loop_range, _coroutine(loop_range), 100000, 100000, 10000, 10000)),
+    ("arithmetic", Workload(arithmetic, _coroutine(arithmetic), 100000, 100000, 10000, 10000)),
+    ("global_loads", Workload(global_loads, _coroutine(global_loads), 100000, 300000, 10000, 30000)),
+    ("fib", Workload(fib, aio_fib, 18, 8361, 12, 465)),
+    ("raise_catch", Workload(raise_catch, _coroutine(raise_catch), 10000, 10000, 1000, 1000)),
+])
+
+# The numbers of contexts for the scheduling benchmarks.
+TASK_COUNTS = (1000, 10000, 100000)
+QUICK_TASK_COUNTS = (1000, 10000)
+
+
+def best_of(repeat: int, func: callable) -> float:
+    """
+    :return: The fastest time out of `repeat` runs of `func`, in seconds.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def throughput_result(name: str, ops: int, seconds: dict) -> dict:
+    result = {"name": name, "unit": "ops/sec", "ops": ops}
+    for runner, elapsed in seconds.items():
+        result[runner] = {"seconds": elapsed, "ops_per_sec": ops / elapsed}
+
+    # How many times slower Vanstein is.
+    result["vanstein_vs_cpython"] = seconds["vanstein"] / seconds["cpython"]
+    result["vanstein_vs_asyncio"] = seconds["vanstein"] / seconds["asyncio"]
+    return result
+
+
+def bench_workload(name: str, workload: Workload, repeat: int, quick: bool) -> dict:
+    arg, ops = (workload.quick_arg, workload.quick_ops) if quick else (workload.arg, workload.ops)
+    vs_func = async_func(workload.func)
+    vs_loop = BaseAsyncLoop()
+    aio_loop = asyncio.new_event_loop()
+
+    # Make sure everything gets the same answer, which also warms up the code caches.
+    expected = workload.func(arg)
+    assert vs_loop.run(vs_func(arg)) == expected, name
+    assert aio_loop.run_until_complete(workload.aio(arg)) == expected, name
+
+    seconds = {
+        "cpython": best_of(repeat, lambda: workload.func(arg)),
+        "vanstein": best_of(repeat, lambda: vs_loop.run(vs_func(arg))),
+        "asyncio": best_of(repeat, lambda: aio_loop.run_until_complete(workload.aio(arg))),
+    }
+
+    vs_loop.close()
+    aio_loop.close()
+    return throughput_result(name, ops, seconds)
+
+
+def bench_tasks(count: int, repeat: int) -> dict:
+    """
+    Schedules `count` concurrent tasks, and waits for all of them.
+    """
+    vs_task = async_func(task)
+    vs_loop = BaseAsyncLoop()
+    aio_loop = asyncio.new_event_loop()
+
+    def run_asyncio():
+        return aio_loop.run_until_complete(asyncio.gather(*[aio_task(i) for i in range(count)], loop=aio_loop))
+
+    seconds = {
+        "cpython": best_of(repeat, lambda: [task(i) for i in range(count)]),
+        "vanstein": best_of(repeat, lambda: vs_loop.run_until_complete(*[vs_task(i) for i in range(count)])),
+        "asyncio": best_of(repeat, run_asyncio),
+    }
+
+    vs_loop.close()
+    aio_loop.close()
+    return throughput_result("tasks_{}".format(count), count, seconds)
+
+
+def _allocated_per_item(count: int, create: callable) -> float:
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    items = create(count)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    del items
+    return (after - before) / count
+
+
+def bench_memory(count: int) -> dict:
+    """
+    Measures the memory used by each pending task.
+    """
+    vs_task = async_func(task)
+    aio_loop = asyncio.new_event_loop()
+
+    vs_bytes = _allocated_per_item(count, lambda n: [vs_task(i) for i in range(n)])
+
+    def create_asyncio(n):
+        return [aio_loop.create_task(aio_task(i)) for i in range(n)]
+
+    aio_bytes = _allocated_per_item(count, create_asyncio)
+    # Let the tasks finish, so they don't complain about being destroyed while pending.
+    aio_loop.run_until_complete(asyncio.sleep(0, loop=aio_loop))
+    aio_loop.close()
+
+    return {
+        "name": "memory_per_context",
+        "unit": "bytes",
+        "ops": count,
+        "vanstein": {"bytes": vs_bytes},
+        "asyncio": {"bytes": aio_bytes},
+        "vanstein_vs_asyncio": vs_bytes / aio_bytes,
+    }
+
+
+def run_suite(names: list, repeat: int, quick: bool) -> list:
+    benchmarks = []
+    for name, workload in WORKLOADS.items():
+        benchmarks.append((name, lambda name=name, workload=workload: bench_workload(name, workload, repeat, quick)))
+
+    for count in (QUICK_TASK_COUNTS if quick else TASK_COUNTS):
+        benchmarks.append(("tasks_{}".format(count), lambda count=count: bench_tasks(count, repeat)))
+
+    benchmarks.append(("memory_per_context", lambda: bench_memory(1000 if quick else 10000)))
+
+    results = []
+    for name, bench in benchmarks:
+        if names and name not in names:
+            continue
+
+        results.append(bench())
+        print_result(results[-1])
+
+    return results
+
+
+def print_result(result: dict):
+    if result["unit"] == "bytes":
+        print("{:<20} vanstein {:>10,.0f} B   asyncio {:>10,.0f} B   {:>6.2f}x asyncio".format(
+            result["name"], result["vanstein"]["bytes"], result["asyncio"]["bytes"], result["vanstein_vs_asyncio"]
+        ))
+        return
+
+    print("{:<20} cpython {:>14,.0f}/s   vanstein {:>12,.0f}/s   asyncio {:>14,.0f}/s   "
+          "{:>7.1f}x cpython {:>7.1f}x asyncio".format(
+              result["name"], result["cpython"]["ops_per_sec"], result["vanstein"]["ops_per_sec"],
+              result["asyncio"]["ops_per_sec"], result["vanstein_vs_cpython"], result["vanstein_vs_asyncio"]
+          ))
+
+
+def main(argv: list):
+    parser = argparse.ArgumentParser(description="Benchmarks Vanstein against plain CPython and asyncio.")
+    parser.add_argument("benchmarks", nargs="*", help="The benchmarks to run; all of them by default.")
+    parser.add_argument("--repeat", type=int, default=5, help="The number of runs to take the best of.")
+    parser.add_argument("--quick", action="store_true", help="Use smaller inputs, for a quick check.")
+    parser.add_argument("--json", metavar="PATH", help="Also write the results to a file as JSON.")
+    args = parser.parse_args(argv[1:])
+
+    results = run_suite(args.benchmarks, args.repeat, args.quick)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                # The platform module is hijacked, so ask sys instead.
+                "python": "{}.{}.{}".format(*sys.version_info[:3]),
+                "implementation": sys.implementation.name,
+                "vanstein": vanstein.__version__,
+                "quick": args.quick,
+                "repeat": args.repeat,
+                "results": results,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
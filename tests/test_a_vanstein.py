@@ -4,20 +4,38 @@ Test A: Testing Vanstein.
 This is to ensure the loop and the bytecode engine works properly, not to test it in all scenarios.
 """
 import vanstein
-from vanstein.decorators import async_func, native_invoke
+from vanstein.decorators import async_func, in_executor, native_invoke
 
 vanstein.hijack()
 
-from vanstein.loop import BaseAsyncLoop
+from vanstein.aio import AsyncioBridge, await_asyncio
+from vanstein.context import CancelledError
+from vanstein.futures import Future
+from vanstein.interpreter.profiler import SamplingProfiler
+from vanstein.locks import Condition, Event, Lock, Semaphore
+from vanstein.loop import BaseAsyncLoop, gather, sleep, spawn, wait_for, wait_readable, wait_writable
+from vanstein.queues import Queue
+from vanstein.sharding import ShardedLoop
+import asyncio
+import collections
+import concurrent.futures
+import json
+import os
 import pytest
+import signal
+import socket
+import threading
+import time
 
 
 @pytest.fixture
 def vs_loop():
     """
-    A fixture that creates a Vanstein event loop each test.
+    A fixture that creates a Vanstein event loop each test, and closes it afterwards.
     """
-    return BaseAsyncLoop()
+    loop = BaseAsyncLoop()
+    yield loop
+    loop.close()
 
 
 # BEGIN TESTS
@@ -76,3 +94,644 @@ def test_call_function(vs_loop: BaseAsyncLoop):
     # Tests calling some regular functions.
     assert vs_loop.run(a2()) == 2
     assert vs_loop.run(a3()) == 3
+
+
+def test_shared_instructions():
+    # Contexts for the same function share one compiled instruction stream.
+    first, second = a1(), a1()
+    assert first.compiled is second.compiled
+    assert first.compiled is not a2().compiled
+
+
+def test_code_cache_eviction():
+    from vanstein.interpreter.code_cache import CodeCache
+
+    cache = CodeCache(lambda code: code.co_name, maxsize=2)
+    codes = [b1.__code__, b3.__code__, test_code_cache_eviction.__code__]
+    for code in codes:
+        assert cache.get(code) == code.co_name
+
+    assert len(cache) == 2
+    assert codes[0] not in cache
+    assert codes[2] in cache
+
+
+@async_func
+def branch(x):
+    if x:
+        return 1
+    return 2
+
+
+def test_jumps(vs_loop: BaseAsyncLoop):
+    # POP_JUMP_IF_FALSE jumps to an absolute offset.
+    assert vs_loop.run(branch(0)) == 2
+    assert vs_loop.run(branch(1)) == 1
+
+    # Every jump has its target resolved to an instruction index when it's compiled.
+    ctx = branch(0)
+    instructions = ctx.instructions
+    for (instruction, target) in zip(instructions, ctx.compiled.targets):
+        if target != -1:
+            assert instructions[target].offset == instruction.argval
+
+
+@async_func
+def call_it(f): return f()
+
+
+def test_call_site_cache(vs_loop: BaseAsyncLoop):
+    # The same call site is used with a native function, a VS function and a regular function.
+    assert vs_loop.run(call_it(b1)) == 2
+    assert vs_loop.run(call_it(b2)) == 2
+    assert vs_loop.run(call_it(b3)) == 3
+    assert vs_loop.run(call_it(b1)) == 2
+
+    # Without context switching, the same call site calls VS functions natively, which returns a context.
+    assert vs_loop.run(call_it(b2)) == 2
+    vs_loop.bytecode_engine.do_context_switching = False
+    assert type(vs_loop.run(call_it(b2))).__name__ == "_VSContext"
+
+
+@async_func
+def append_all(out, n):
+    for i in range(n):
+        out.append(i)
+    return len(out)
+
+
+def test_call_site_cache_builtin_methods(vs_loop: BaseAsyncLoop):
+    # Builtin bound methods are new objects every time, so they're called natively without being classified.
+    engine = vs_loop.bytecode_engine
+    classified = []
+    classify = engine._classify_callable
+    engine._classify_callable = lambda fn: classified.append(fn) or classify(fn)
+
+    assert vs_loop.run(append_all([], 1000)) == 1000
+    assert len(classified) < 5
+
+
+@native_invoke
+def raises(): raise ValueError("x")
+
+
+@async_func
+def catch_native():
+    try:
+        raises()
+    except ValueError:
+        return 1
+    return 2
+
+
+def test_native_exception(vs_loop: BaseAsyncLoop):
+    # An exception from a native call jumps to the except block, without pushing a result.
+    assert vs_loop.run(catch_native()) == 1
+
+
+@async_func
+def nested(): return a2()
+
+
+@async_func
+def vs_raises(): return raises()
+
+
+@async_func
+def propagate(): return vs_raises()
+
+
+@async_func
+def catch_vs():
+    try:
+        propagate()
+    except ValueError:
+        return 1
+    return 2
+
+
+@pytest.mark.parametrize("direct_handoff", [True, False])
+def test_call_chain(vs_loop: BaseAsyncLoop, direct_handoff: bool):
+    # Results and exceptions make their way back up the call chain, with or without going through the loop.
+    vs_loop.bytecode_engine.direct_handoff = direct_handoff
+    assert vs_loop.run(nested()) == 2
+    assert vs_loop.run(catch_vs()) == 1
+
+
+def test_suspended_tasks_parked(vs_loop: BaseAsyncLoop):
+    # SUSPENDED tasks wait outside of the deque, and are moved back onto it when they're woken up.
+    vs_loop.bytecode_engine.direct_handoff = False
+    ctx = nested()
+    vs_loop.running_tasks.append(ctx)
+    vs_loop._running = True
+
+    vs_loop._step()
+    assert vs_loop.suspended_tasks == {ctx}
+    assert list(vs_loop.running_tasks) == [ctx.next_ctx]
+
+    vs_loop.run_forever()
+    assert not vs_loop.suspended_tasks
+    assert ctx.result == 2
+    vs_loop._running = False
+
+
+@async_func
+def count(n):
+    total = 0
+    for i in range(n):
+        total += i
+    return total
+
+
+@pytest.mark.parametrize("direct_handoff", [True, False])
+def test_instruction_budget(vs_loop: BaseAsyncLoop, direct_handoff: bool):
+    # A long loop is preempted, and carries on from where it left off.
+    vs_loop.bytecode_engine.direct_handoff = direct_handoff
+    vs_loop.bytecode_engine.instruction_budget = 10
+    ctx = count(100)
+    assert vs_loop.run(ctx) == sum(range(100))
+
+    stats = ctx.slice_stats
+    assert stats.preemptions > 0
+    assert stats.slices == stats.preemptions + 1
+    assert stats.max_slice == 10
+
+
+@async_func
+def ping(a, b):
+    wait_writable(b)
+    b.send(b"ping")
+    wait_readable(a)
+    return a.recv(4)
+
+
+def test_io(vs_loop: BaseAsyncLoop):
+    # Contexts park until their sockets are ready.
+    a, b = socket.socketpair()
+    with a, b:
+        assert vs_loop.run(ping(a, b)) == b"ping"
+        assert not vs_loop._has_events()
+
+        # Nothing is ready to run, so the loop blocks until the socket is written to from another thread.
+        threading.Timer(0.05, b.send, [b"pong"]).start()
+        assert vs_loop.run(ping(a, a)) == b"pong"
+
+
+@async_func
+def sleeper(seconds):
+    return sleep(seconds, seconds)
+
+
+def test_timers(vs_loop: BaseAsyncLoop):
+    # Timers run in deadline order, and sleeping contexts wake up once their timer is due.
+    called = []
+    vs_loop.call_later(0.02, called.append, 2)
+    vs_loop.call_later(0.01, called.append, 1)
+    vs_loop.call_later(0.01, called.append, "cancelled").cancel()
+
+    start = time.monotonic()
+    assert vs_loop.run(sleeper(0.05)) == 0.05
+    assert time.monotonic() - start >= 0.05
+    assert called == [1, 2]
+
+
+@in_executor
+def blocking(x):
+    if x is None:
+        raise ValueError("x")
+    time.sleep(0.01)
+    return x, threading.current_thread() is not threading.main_thread()
+
+
+@async_func
+def offload(x):
+    try:
+        return blocking(x)
+    except ValueError:
+        return "caught"
+
+
+def test_executor(vs_loop: BaseAsyncLoop):
+    # Blocking functions run in another thread, and hand their result or exception back to the context.
+    assert vs_loop.run(offload(1)) == (1, True)
+    assert vs_loop.run(offload(None)) == "caught"
+    vs_loop.close()
+
+
+def test_executor_process_pool(vs_loop: BaseAsyncLoop):
+    # The same functions can run in another process.
+    vs_loop.set_default_executor(concurrent.futures.ProcessPoolExecutor(1))
+    assert vs_loop.run(offload(1)) == (1, False)
+    assert vs_loop.run(offload(None)) == "caught"
+    vs_loop.close()
+
+
+@async_func
+def fan_out():
+    first = spawn(sleeper, 0.05)
+    second = spawn(sleeper, 0.05)
+    return gather(first, second, spawn(count, 10))
+
+
+def test_spawn_gather(vs_loop: BaseAsyncLoop):
+    # Spawned contexts run concurrently, so both sleeps overlap.
+    start = time.monotonic()
+    assert vs_loop.run(fan_out()) == [0.05, 0.05, sum(range(10))]
+    assert time.monotonic() - start < 0.1
+
+
+def test_run_until_complete(vs_loop: BaseAsyncLoop):
+    contexts = [count(i % 10) for i in range(1000)]
+    assert vs_loop.run_until_complete(*contexts) == [sum(range(i % 10)) for i in range(1000)]
+
+
+@async_func
+def waiter(fut):
+    return fut.wait()
+
+
+@async_func
+def catch_future(fut):
+    try:
+        return fut.wait()
+    except ValueError:
+        return "caught"
+
+
+def test_future_fan_out(vs_loop: BaseAsyncLoop):
+    # Every waiter on a future is woken up with the same result.
+    fut = Future()
+    vs_loop.call_later(0, fut.set_result, 42)
+    assert vs_loop.run_until_complete(*[waiter(fut) for i in range(100)]) == [42] * 100
+    assert vs_loop.run(waiter(fut)) == 42
+
+    fut = Future()
+    vs_loop.call_later(0, fut.set_exception, ValueError("x"))
+    assert vs_loop.run(catch_future(fut)) == "caught"
+
+
+@async_func
+def producer(q, n):
+    for i in range(n):
+        q.put(i)
+    q.put_many(range(n, n * 2))
+    q.put(None)
+
+
+@async_func
+def consumer(q, batch):
+    total = 0
+    while True:
+        for item in q.get_many(batch):
+            if item is None:
+                return total
+            total += item
+
+
+@async_func
+def pipeline(n, maxsize, batch):
+    q = Queue(maxsize)
+    return gather(spawn(consumer, q, batch), spawn(producer, q, n))
+
+
+@pytest.mark.parametrize("maxsize,batch", [(1, 1), (4, 3), (0, 100)])
+def test_queue(vs_loop: BaseAsyncLoop, maxsize: int, batch: int):
+    # Items flow from the producer to the consumer in order, with the producer parked while the queue is full.
+    assert vs_loop.run(pipeline(100, maxsize, batch)) == [sum(range(200)), None]
+
+
+class Tracker(object):
+    # Records how many contexts are inside a section at once.
+    def __init__(self):
+        self.active = 0
+        self.peak = 0
+        self.order = []
+
+    @native_invoke
+    def enter(self):
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+
+    @native_invoke
+    def leave(self, name):
+        self.active -= 1
+        self.order.append(name)
+
+
+@async_func
+def limited(sem, tracker, name):
+    sem.acquire()
+    tracker.enter()
+    sleep(0.01)
+    tracker.leave(name)
+    sem.release()
+
+
+@pytest.mark.parametrize("sem,peak", [(Lock, 1), (lambda: Semaphore(2), 2)])
+def test_semaphore(vs_loop: BaseAsyncLoop, sem, peak: int):
+    # Waiters are let in first come, first served, and never more than the limit at once.
+    sem = sem()
+    tracker = Tracker()
+    vs_loop.run_until_complete(*[limited(sem, tracker, i) for i in range(6)])
+    assert tracker.peak == peak
+    assert tracker.order == list(range(6))
+    assert not sem.locked()
+
+
+@async_func
+def take(cond, items):
+    cond.acquire()
+    while not items:
+        cond.wait()
+    item = items.pop()
+    cond.release()
+    return item
+
+
+@async_func
+def give(cond, items, event):
+    event.wait()
+    cond.acquire()
+    items.append(1)
+    items.append(2)
+    cond.notify_all()
+    cond.release()
+
+
+def test_condition(vs_loop: BaseAsyncLoop):
+    cond, event, items = Condition(), Event(), []
+    vs_loop.call_later(0, event.set)
+    assert vs_loop.run_until_complete(take(cond, items), take(cond, items), give(cond, items, event)) == [2, 1, None]
+    assert not cond.locked()
+
+
+@async_func
+def slow():
+    return sleeper(10)
+
+
+@async_func
+def catch_cancel(lock):
+    try:
+        return lock.acquire()
+    except CancelledError:
+        return "cancelled"
+
+
+def test_cancel(vs_loop: BaseAsyncLoop):
+    # Cancelling a context stops whatever it's waiting on, however deep.
+    ctx = slow()
+    vs_loop.call_later(0.01, ctx.cancel)
+    assert vs_loop.run(ctx) is None
+    assert isinstance(ctx._exception_state, CancelledError)
+    assert vs_loop._next_deadline() is None
+    assert not ctx.cancel()
+
+    lock = Lock()
+    lock._locked = True
+    ctx = catch_cancel(lock)
+    vs_loop.call_later(0, ctx.cancel)
+    assert vs_loop.run(ctx) == "cancelled"
+    assert not lock._waiters
+
+
+@async_func
+def acquire_release(lock):
+    lock.acquire()
+    lock.release()
+    return "acquired"
+
+
+@async_func
+def catch_cancel_get(q):
+    try:
+        return q.get()
+    except CancelledError:
+        return "cancelled"
+
+
+def test_cancel_after_handoff(vs_loop: BaseAsyncLoop):
+    # A context that's cancelled after it was handed a lock or an item, but before it ran, gives it to the next one.
+    lock = Lock()
+    lock._locked = True
+    victim = catch_cancel(lock)
+
+    def release():
+        lock.release()
+        victim.cancel()
+
+    vs_loop.call_later(0.01, release)
+    assert vs_loop.run_until_complete(victim, acquire_release(lock)) == ["cancelled", "acquired"]
+    assert not lock.locked()
+
+    q = Queue()
+    victim = catch_cancel_get(q)
+
+    def put():
+        q._put_items(collections.deque(["item"]))
+        victim.cancel()
+
+    vs_loop.call_later(0.01, put)
+    assert vs_loop.run_until_complete(victim, catch_cancel_get(q)) == ["cancelled", "item"]
+    assert q.empty()
+
+
+@async_func
+def timed(seconds, timeout):
+    try:
+        return wait_for(spawn(sleeper, seconds), timeout)
+    except TimeoutError:
+        return "timeout"
+
+
+def test_wait_for(vs_loop: BaseAsyncLoop):
+    start = time.monotonic()
+    assert vs_loop.run(timed(10, 0.01)) == "timeout"
+    assert time.monotonic() - start < 1
+    assert vs_loop.run(timed(0.01, 1)) == 0.01
+
+
+async def aio_double(x):
+    await asyncio.sleep(0.01)
+    if x is None:
+        raise ValueError("x")
+    return x * 2
+
+
+@async_func
+def bridged(x):
+    try:
+        return await_asyncio(aio_double(x)) + 1
+    except ValueError:
+        return "caught"
+
+
+def test_asyncio_bridge(vs_loop: BaseAsyncLoop):
+    # Contexts and asyncio coroutines can wait on each other, with both loops running at once.
+    aio_loop = asyncio.new_event_loop()
+    bridge = AsyncioBridge(vs_loop, aio_loop)
+
+    async def main():
+        return await asyncio.gather(bridge.wrap(bridged(1)), bridge.wrap(bridged(None)), bridge.wrap(sleeper(0.01)))
+
+    assert aio_loop.run_until_complete(main()) == [3, "caught", 0.01]
+
+    # A stray wakeup doesn't make asyncio keep running rounds while the loop is idle.
+    rounds = []
+    run_round = vs_loop._run_round
+    vs_loop._run_round = lambda **kwargs: rounds.append(1) or run_round(**kwargs)
+    vs_loop._wakeup_writer.send(b"\0")
+    aio_loop.run_until_complete(asyncio.sleep(0.1))
+    assert len(rounds) < 5
+    bridge.close()
+    aio_loop.close()
+
+
+def test_threadsafe(vs_loop: BaseAsyncLoop):
+    # Other threads can wake up a loop that's blocked waiting on a timer, and get results back from it.
+    fut = Future()
+    results = []
+
+    def worker():
+        time.sleep(0.01)
+        vs_loop.call_soon_threadsafe(fut.set_result, 5)
+        results.append(vs_loop.submit_threadsafe(count, 10).result(timeout=1))
+        results.append(time.monotonic() - start)
+
+    thread = threading.Thread(target=worker)
+    start = time.monotonic()
+    thread.start()
+    assert vs_loop.run_until_complete(waiter(fut), sleeper(0.2)) == [5, 0.2]
+    thread.join()
+    assert results[0] == sum(range(10))
+    assert results[1] < 0.1
+
+
+def test_threadsafe_wakeup(vs_loop: BaseAsyncLoop):
+    # A loop with nothing else to do can block until another thread wakes it up.
+    fut = Future()
+    threading.Timer(0.05, vs_loop.call_soon_threadsafe, [fut.set_result, 5]).start()
+    start = time.monotonic()
+    assert vs_loop.run(waiter(fut), wait_for_threads=True) == 5
+    assert time.monotonic() - start >= 0.05
+
+    fut = Future()
+    threading.Timer(0.05, vs_loop.call_soon_threadsafe, [fut.set_result, 6]).start()
+    assert vs_loop.run_until_complete(waiter(fut), wait_for_threads=True) == [6]
+
+    # Otherwise, nothing can wake it up, even with the executor's threads still around.
+    assert vs_loop.run(offload(1)) == (1, True)
+    with pytest.raises(RuntimeError, match="Deadlock"):
+        vs_loop.run(waiter(Future()))
+    with pytest.raises(RuntimeError, match="Deadlock"):
+        vs_loop.run_until_complete(waiter(Future()))
+
+
+@async_func
+def shard_pid(seconds):
+    sleep(seconds)
+    return os.getpid()
+
+
+def test_sharded_loop():
+    # Calls are spread across the shards, and results and exceptions come back to the parent.
+    with ShardedLoop(2) as loop:
+        assert loop.run(count, 10) == sum(range(10))
+        pids = loop.gather(*[loop.submit(shard_pid, 0.05) for _ in range(4)])
+        assert len(set(pids)) == 2
+        assert os.getpid() not in pids
+
+        with pytest.raises(ValueError):
+            loop.run(vs_raises)
+
+        # Once a shard has exited, calls only go to the shards that are left.
+        os.kill(loop._processes[0].pid, signal.SIGKILL)
+        loop._processes[0].join()
+        assert loop.gather(*[loop.submit(count, 10) for _ in range(6)]) == [sum(range(10))] * 6
+
+        os.kill(loop._processes[1].pid, signal.SIGKILL)
+        loop._processes[1].join()
+        loop._receiver.join()
+        with pytest.raises(RuntimeError, match="Every shard"):
+            loop.submit(count, 10)
+
+
+@async_func
+def catch_own():
+    try:
+        raise ValueError("x")
+    except ValueError:
+        return 1
+
+
+@async_func
+def propagate_deep(): return propagate()
+
+
+@pytest.mark.parametrize("direct_handoff", [True, False])
+@pytest.mark.parametrize("budget", [None, 2])
+def test_metrics(vs_loop: BaseAsyncLoop, tmp_path, budget, direct_handoff: bool):
+    assert "engine" not in vs_loop.stats()
+
+    vs_loop.bytecode_engine.instruction_budget = budget
+    vs_loop.bytecode_engine.direct_handoff = direct_handoff
+    vs_loop.enable_metrics()
+    vs_loop.dump_stats_periodically(str(tmp_path / "stats.jsonl"), 0.01)
+    results = vs_loop.run_until_complete(count(10), catch_native(), sleeper(0.05), propagate(), catch_own(),
+                                         propagate_deep())
+    assert results[:3] == [sum(range(10)), 1, 0.05]
+    assert results[4] == 1
+
+    stats = vs_loop.stats()
+    assert stats["ready"] == stats["suspended"] == 0
+    engine = stats["engine"]
+    assert engine["instructions"] > 0
+    assert engine["native_calls"] > 0 and engine["vs_calls"] > 0 and engine["suspending_calls"] > 0
+    assert engine["contexts_created"] == 6 + engine["vs_calls"]
+    assert engine["contexts_created"] == engine["contexts_finished"] + engine["contexts_errored"]
+    assert engine["exceptions_injected"] == 4
+    assert stats["loop"]["steps"] == stats["loop"]["slice_duration"]["count"] > 0
+    assert stats["loop"]["ready_latency"]["count"] > 0
+
+    dumps = (tmp_path / "stats.jsonl").read_text().splitlines()
+    assert dumps and "engine" in json.loads(dumps[-1])
+
+    # Once metrics are disabled, nothing counts into them any more.
+    metrics = vs_loop.bytecode_engine.metrics
+    vs_loop.disable_metrics()
+    vs_loop.run(propagate())
+    assert metrics.snapshot() == engine
+
+
+@pytest.mark.parametrize("budget", [None, 7])
+def test_opcode_profiler(vs_loop: BaseAsyncLoop, tmp_path, budget):
+    vs_loop.bytecode_engine.instruction_budget = budget
+    profiler = vs_loop.bytecode_engine.enable_profiling()
+    assert vs_loop.run(count(10)) == sum(range(10))
+    assert vs_loop.bytecode_engine.disable_profiling() is profiler
+
+    opcodes = {opname: count for (opname, count, seconds) in profiler.opcode_stats()}
+    assert opcodes["FOR_ITER"] == 11
+    assert opcodes["RETURN_VALUE"] == 1
+    assert profiler.hot_spots(1)[0][0] == "count"
+    assert "FOR_ITER" in profiler.report()
+
+    profiler.dump_json(str(tmp_path / "profile.json"))
+    assert json.loads((tmp_path / "profile.json").read_text())["opcodes"]
+
+
+@async_func
+def count_twice(n):
+    return count(n) + count(n)
+
+
+@pytest.mark.parametrize("use_signal", [False, True])
+def test_sampling_profiler(vs_loop: BaseAsyncLoop, use_signal: bool):
+    # Samples show the whole VS call chain, not just the running context.
+    with SamplingProfiler(vs_loop.bytecode_engine, 0.001, use_signal) as profiler:
+        vs_loop.run(count_twice(20000))
+
+    stacks = [stack for stack in profiler.samples if stack.startswith("count_twice:")]
+    assert stacks
+    assert any(";count:" in stack for stack in stacks)
+    assert profiler.folded().splitlines()[0].rsplit(" ", 1)[1].isdigit()
@@ -0,0 +1,182 @@
+"""
+asyncio interoperability.
+
+This runs a Vanstein loop inside an asyncio event loop, so that the two can wait on each other:
+
+ - :meth:`AsyncioBridge.wrap` turns a context into an asyncio Future, which asyncio code can await.
+ - :func:`await_asyncio` parks a context until an asyncio Future or coroutine is done, without blocking any other
+   context.
+
+Example usage:
+.. code:: python
+
+    @async_func
+    def handler(reader):
+        line = await_asyncio(reader.readline())
+        return legacy_parse(line)
+
+    bridge = AsyncioBridge(BaseAsyncLoop())
+    result = await bridge.wrap(handler(reader))
+"""
+import asyncio
+import functools
+
+from vanstein.context import _VSContext, CancelledError
+from vanstein.decorators import suspending
+from vanstein.loop import BaseAsyncLoop, get_running_loop
+
+# How often to poll the loop's selector for events, if it can't be waited on by asyncio.
+POLL_INTERVAL = 0.01
+
+
+class AsyncioBridge(object):
+    """
+    Drives a Vanstein loop from inside an asyncio event loop.
+
+    The Vanstein loop is ran one round at a time from asyncio callbacks, and never blocks; asyncio is told when the
+    next round is due instead.
+    """
+
+    def __init__(self, vs_loop: BaseAsyncLoop, aio_loop: asyncio.AbstractEventLoop = None):
+        self.vs_loop = vs_loop
+        self.aio_loop = aio_loop or asyncio.get_event_loop()
+
+        # The asyncio handle for the next round, if one is scheduled.
+        self._handle = None
+
+        # The selector's file descriptor, if asyncio is watching it.
+        # This makes asyncio run a round as soon as the Vanstein loop has an event, including a callback scheduled
+        # from another thread.
+        self._selector_fd = None
+
+        self._closed = False
+
+        try:
+            fd = vs_loop.selector.fileno()
+        except AttributeError:
+            # This selector can't be waited on, so it's polled instead.
+            pass
+        else:
+            self.aio_loop.add_reader(fd, self._run_round)
+            self._selector_fd = fd
+
+    def __repr__(self):
+        return "<AsyncioBridge vs_loop={!r} aio_loop={!r}>".format(self.vs_loop, self.aio_loop)
+
+    def wrap(self, context: _VSContext) -> asyncio.Future:
+        """
+        Spawns a context on the Vanstein loop, and returns an asyncio Future for its result.
+
+        Cancelling the future cancels the context.
+        """
+        if self._closed:
+            raise RuntimeError("Bridge is closed")
+
+        future = self.aio_loop.create_future()
+
+        def on_result(result):
+            if not future.done():
+                future.set_result(result)
+
+        def on_exception(exception: BaseException):
+            if not future.done():
+                future.set_exception(exception)
+
+        def on_done(f: asyncio.Future):
+            if f.cancelled():
+                context.cancel()
+                self._schedule(0)
+
+        context.add_done_callback(on_result)
+        context.add_exception_callback(on_exception)
+        future.add_done_callback(on_done)
+
+        self.vs_loop.spawn(context)
+        self._schedule(0)
+        return future
+
+    def _schedule(self, delay: float):
+        """
+        Schedules the next round of the Vanstein loop on asyncio.
+        """
+        if self._handle is not None:
+            self._handle.cancel()
+
+        self._handle = self.aio_loop.call_later(delay, self._run_round)
+
+    def _run_round(self):
+        self._handle = None
+        if self._closed:
+            return
+
+        vs_loop = self.vs_loop
+        vs_loop._run_loop(once=True)
+
+        if vs_loop.running_tasks or vs_loop._threadsafe_callbacks:
+            delay = 0
+        else:
+            deadline = vs_loop._next_deadline()
+            delay = None if deadline is None else max(0, deadline - vs_loop.time())
+
+        if self._selector_fd is None and vs_loop._has_events():
+            delay = POLL_INTERVAL if delay is None else min(delay, POLL_INTERVAL)
+
+        if delay is not None:
+            self._schedule(delay)
+
+    def close(self):
+        """
+        Stops driving the Vanstein loop.
+
+        This does not close either loop.
+        """
+        self._closed = True
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+        if self._selector_fd is not None:
+            self.aio_loop.remove_reader(self._selector_fd)
+            self._selector_fd = None
+
+
+def _finish_waiter(ctx: _VSContext, waiting: list, future: asyncio.Future):
+    if not waiting[0]:
+        # The context was cancelled.
+        return
+
+    waiting[0] = False
+    if future.cancelled():
+        ctx.resume_exception(CancelledError())
+    elif future.exception() is not None:
+        ctx.resume_exception(future.exception())
+    else:
+        ctx.resume(future.result())
+
+
+@suspending
+def await_asyncio(ctx: _VSContext, awaitable):
+    """
+    Parks the calling context until an asyncio Future or coroutine is done.
+
+    This can only be called from a loop driven by an :class:`AsyncioBridge`; coroutines are scheduled on its asyncio
+    loop. Cancelling the context cancels the future.
+
+    :return: The result of the future.
+        If the future has an exception, it is raised instead.
+    """
+    loop = get_running_loop()
+    future = asyncio.ensure_future(awaitable)
+    if future.done() and not future.cancelled():
+        return future.result()
+
+    # [if the context is parked]
+    waiting = [True]
+
+    def on_cancel():
+        waiting[0] = False
+        future.cancel()
+
+    # The result is handed over through the loop's self-pipe, which also makes the bridge run a round.
+    future.add_done_callback(functools.partial(loop.call_soon_threadsafe, _finish_waiter, ctx, waiting))
+    ctx.suspend(on_cancel)
@@ -10,10 +10,11 @@ except AttributeError:
 # This uses Enum34 for Python 3.3 and below.
 import enum
 
-# Sentinel value which means no result.
-import collections
 import types
 
+from vanstein.interpreter.code_cache import CompiledCode, get_compiled
+
+# Sentinel value which means no result.
 NO_RESULT = type("NO_RESULT", (), {})
 
 
@@ -36,6 +37,58 @@ class VSCtxState(enum.Enum):
     ERRORED = 5
 
 
+class CancelledError(BaseException):
+    """
+    Raised inside a context when it is cancelled.
+
+    This isn't an Exception, so that `except Exception` blocks don't stop the context from being cancelled.
+    """
+
+
+def run_callbacks(callbacks: list, *args):
+    """
+    Calls every callback in a list.
+
+    Every callback is called, even if one of them raises; the first exception raised is re-raised afterwards.
+    """
+    error = None
+    for callback in callbacks:
+        try:
+            callback(*args)
+        except BaseException as e:
+            if error is None:
+                error = e
+
+    if error is not None:
+        raise error
+
+
+class VSSliceStats(object):
+    """
+    Scheduling statistics for a context.
+
+    These are only kept while the engine has an instruction budget, and are useful for tuning it.
+    """
+
+    def __init__(self):
+        # The number of slices the context has ran in.
+        self.slices = 0
+
+        # The number of instructions the context has ran.
+        self.instructions = 0
+
+        # The most instructions the context has ran in one slice.
+        self.max_slice = 0
+
+        # The number of times the context has ran out of budget, and been preempted.
+        self.preemptions = 0
+
+    def __repr__(self):
+        return "<VSSliceStats slices={} instructions={} max_slice={} preemptions={}>".format(
+            self.slices, self.instructions, self.max_slice, self.preemptions
+        )
+
+
 class _VSContext(object):
     """
     The raw context class for a function.
@@ -51,10 +104,11 @@ class _VSContext(object):
         # We change this when we switch contexts.
         self.state = VSCtxState.PENDING
 
-        # The done callback.
-        # This is automatically called when our state switches to FINISHED i.e when we've executed fully.
+        # The done callbacks.
+        # These are automatically called when our state switches to FINISHED i.e when we've executed fully.
         # This usually just notifies our dependant task that we have a result.
-        self._done_callback = None
+        # The list is only created when the first callback is added.
+        self._done_callbacks = None
 
         # The result of our underlying function.
         # This is only not NO_RESULT when the state is FINISHED.
@@ -62,12 +116,13 @@ class _VSContext(object):
 
         # Vanstein bytecode internals.
 
-        # The current list of instructions.
-        self._instructions = []
+        # The compiled code object, which holds the instructions the engine runs.
+        # This is shared with every other context for the same function, and is loaded on first use.
+        self._compiled = None
 
         # The current stack for this function.
         # This is used when executing bytecode that edits the stack.
-        self.stack = collections.deque(maxlen=self.__code__.co_stacksize)
+        self.stack = []
 
         # The current names and varnames.
         # These are only the actual values, NOT the names.
@@ -92,7 +147,39 @@ class _VSContext(object):
         self._handling_exception = False
         self._exception_state = None
 
-        self._exception_callback = None
+        # The exception callbacks.
+        # These are called when an exception bubbles out of us.
+        self._exception_callbacks = None
+
+        # The wakeup callback.
+        # This is set by the event loop when it parks us while we're SUSPENDED, and is called once when we're woken
+        # up again.
+        self._wakeup_callback = None
+
+        # An exception to raise into this context the next time it runs.
+        # This is set by `resume_exception` and `cancel`.
+        self._pending_exception = None
+
+        # The cancel callback.
+        # This is passed to `suspend` by suspending natives, and is called if we're cancelled while suspended, so they
+        # can stop waiting on our behalf.
+        self._cancel_callback = None
+
+        # The handoff callback.
+        # This is passed to `resume` along with something handed to us, such as a lock, and is called if we're
+        # cancelled after we've been woken up but before we've ran, so that it can be handed to someone else instead.
+        self._handoff_callback = None
+
+        # The engine that last ran us, or that created us.
+        # If it has metrics enabled, we count the exceptions raised into us, and erroring, in them.
+        self._engine = None
+
+        # When we were last put on the ready queue, if the loop has metrics enabled.
+        self._ready_at = None
+
+        # The slice statistics for this context.
+        # This is created by the engine the first time we run with an instruction budget.
+        self.slice_stats = None
 
         # The next exception pointer.
         # What does this do? It points to where we should go if an exception was raised.
@@ -148,24 +235,21 @@ class _VSContext(object):
         return self._result
 
     @property
-    def instructions(self):
-        if not self._instructions:
-            self._instructions = list(dis.get_instructions(self))
+    def compiled(self) -> CompiledCode:
+        if self._compiled is None:
+            self._compiled = get_compiled(self.__code__)
+
+        return self._compiled
 
-        return self._instructions
+    @property
+    def instructions(self):
+        # This is only used for debugging; the engine runs off of `compiled` instead.
+        return list(dis.get_instructions(self.__code__))
 
     @property
     def current_instruction(self):
         return self.instructions[self.instruction_pointer]
 
-    def next_instruction(self):
-        """
-        :return: The next instruction to be run.
-            This moves the pointer up by one.
-        """
-        self.instruction_pointer += 1
-        return self.current_instruction
-
     def __repr__(self):
         return "<_VSContext state={} function={} pointer={} stack={}>".format(self.state,
                                                                               self._actual_function,
@@ -212,20 +296,14 @@ class _VSContext(object):
     
     @property
     def f_lasti(self):
-        return self.instructions[self.instruction_pointer].offset
+        return self.compiled.offsets[self.instruction_pointer]
 
     def _get_current_line_number(self):
-        starts_line = self.instructions[self.instruction_pointer].starts_line
-        local_pointer = self.instruction_pointer - 1
-
-        while not starts_line:
-            if local_pointer < 0:
-                return None
-
-            starts_line = self.instructions[local_pointer].starts_line
-            local_pointer -= 1
+        if self.instruction_pointer < 0:
+            return None
 
-        return starts_line
+        # The line table has 0 for instructions before the first line.
+        return self.compiled.lines[self.instruction_pointer] or None
 
     @property
     def f_lineno(self):
@@ -256,22 +334,113 @@ class _VSContext(object):
             return __builtins__[name]
 
     def add_done_callback(self, callback: callable):
+        """
+        Adds a callback to be called with our result, when we finish.
+
+        Any number of callbacks can be added; they are called in the order they were added.
+        """
         if self.state is VSCtxState.FINISHED:
             raise RuntimeError("Cannot add callback to finished context")
 
-        self._done_callback = callback
+        if self._done_callbacks is None:
+            self._done_callbacks = [callback]
+        else:
+            self._done_callbacks.append(callback)
 
     def add_exception_callback(self, callback: callable):
+        """
+        Adds a callback to be called with the exception, if an exception bubbles out of us.
+        """
         if self.state is VSCtxState.FINISHED:
             raise RuntimeError("Cannot add callback to finished context")
 
-        self._exception_callback = callback
+        if self._exception_callbacks is None:
+            self._exception_callbacks = [callback]
+        else:
+            self._exception_callbacks.append(callback)
+
+    def suspend(self, cancel_callback: callable = None):
+        """
+        Suspends this context from inside a suspending native function.
+
+        The context will not run again until `resume` or `resume_exception` is called.
+
+        :param cancel_callback: Called with no arguments if the context is cancelled before it is resumed.
+            This should undo whatever would resume the context, so that it isn't resumed twice.
+        """
+        self.state = VSCtxState.SUSPENDED
+        self._cancel_callback = cancel_callback
+
+    def resume(self, result=None, handoff_callback: callable = None):
+        """
+        Resumes a suspended context.
+
+        :param result: The return value of the call that suspended the context.
+        :param handoff_callback: Called with no arguments if the context is cancelled before it runs again.
+            This should give back whatever was handed to the context along with the result, since it never gets to use
+            it.
+        """
+        self._on_result_cb(result)
+        self._handoff_callback = handoff_callback
+
+    def resume_exception(self, exception: BaseException):
+        """
+        Resumes a suspended context, raising an exception from the call that suspended it.
+
+        The exception is raised when the context next runs, so that the engine can hand it to the right caller.
+        """
+        self._pending_exception = exception
+        self.state = VSCtxState.PENDING
+        self._wake()
+
+    def cancel(self) -> bool:
+        """
+        Cancels this context.
+
+        A CancelledError is raised in the innermost context this one is waiting on (following `next_ctx`), the next
+        time it runs. If nothing catches it, it bubbles out through every caller back up to this context.
+
+        :return: False if the context has already completed, otherwise True.
+        """
+        if self.state is VSCtxState.FINISHED or self.state is VSCtxState.ERRORED:
+            return False
+
+        ctx = self
+        while ctx.state is VSCtxState.SUSPENDED and ctx.next_ctx is not None \
+                and ctx.next_ctx.state is not VSCtxState.FINISHED and ctx.next_ctx.state is not VSCtxState.ERRORED:
+            ctx = ctx.next_ctx
+
+        if ctx.state is VSCtxState.SUSPENDED:
+            # It's waiting inside a suspending native, so tell that to stop waiting, and wake it up.
+            callback, ctx._cancel_callback = ctx._cancel_callback, None
+            if callback is not None:
+                callback()
+            ctx.resume_exception(CancelledError())
+        else:
+            # It's ready to run, or running now; it'll be raised at the start of its next slice.
+            # If it was just woken up with something handed to it, give that back first.
+            callback, ctx._handoff_callback = ctx._handoff_callback, None
+            if callback is not None:
+                callback()
+            ctx._pending_exception = CancelledError()
+
+        return True
+
+    def add_wakeup_callback(self, callback: callable):
+        self._wakeup_callback = callback
+
+    def _wake(self):
+        # We're not suspended in a native any more, so there's nothing to cancel.
+        self._cancel_callback = None
+
+        # Notify whatever parked us that we're no longer waiting.
+        callback, self._wakeup_callback = self._wakeup_callback, None
+        if callback is not None:
+            callback(self)
 
     def finish(self):
-        try:
-            self._done_callback(self._result)
-        except TypeError:
-            return
+        if self._done_callbacks is not None:
+            run_callbacks(self._done_callbacks, self._result)
 
     def _on_result_cb(self, result: None):
         # Default done callback.
@@ -285,6 +454,7 @@ class _VSContext(object):
         # Switch our state to PENDING.
         # This means we're ready to run on the event loop again.
         self.state = VSCtxState.PENDING
+        self._wake()
 
     def _on_exception_cb(self, exception: BaseException):
         # Put the traceback on the stack -> TOS2.
@@ -305,29 +475,33 @@ class _VSContext(object):
             self.state = VSCtxState.PENDING
         else:
             # There's no exc_next_pointer.
-            # This means we can't jump to anywhere; instead we set our state to ERRORED.
-            self.state = VSCtxState.ERRORED
+            # This means we can't jump to anywhere; instead we set our state to ERRORED, and keep bubbling it out.
+            self.raise_exception(exception)
+
+        self._wake()
 
     def inject_exception(self, exception: BaseException):
         """
         Injects an exception into the current context.
 
-        This does nothing YET. However, it will set `_handling_exception` to True, which will signal the VM that the
-        context is currently in an exception context, and should re-raise when a FINALLY is reached.
+        This jumps to the current except block, if there is one; otherwise the exception bubbles out of us.
+        It will also set `_handling_exception` to True, which will signal the VM that the context is currently in an
+        exception context, and should re-raise when a FINALLY is reached.
 
         :param exception: The exception to inject.
         """
+        metrics = self._engine.metrics if self._engine is not None else None
+        if metrics is not None:
+            metrics.exceptions_injected += 1
+
         # Set the current exception state.
         self._exception_state = exception
         self._handling_exception = True
 
-        if self.prev_ctx is None:
-            # We're all by our lonesomes.
-
-            # This means: PUSH the exception contexts on manually.
-            self.push(exception.__traceback__)
-            self.push(exception.__cause__)
-            self.push(exception)
+        # PUSH the exception contexts on manually, for the except block.
+        self.push(exception.__traceback__)
+        self.push(exception.__cause__)
+        self.push(exception)
 
         # Try and move the exception.
         if self.exc_next_pointer:
@@ -349,8 +523,12 @@ class _VSContext(object):
         """
         self.state = VSCtxState.ERRORED
 
-        if self._exception_callback:
-            self._exception_callback(exception)
+        metrics = self._engine.metrics if self._engine is not None else None
+        if metrics is not None:
+            metrics.contexts_errored += 1
+
+        if self._exception_callbacks is not None:
+            run_callbacks(self._exception_callbacks, exception)
 
 
 class VSWrappedFunction(object):
@@ -361,6 +539,13 @@ class VSWrappedFunction(object):
     def __init__(self, function: callable):
         self._f = function
 
+        # Copy the name of the function, so that we're pickled by reference to it, like a regular function.
+        self.__module__ = function.__module__
+        self.__qualname__ = function.__qualname__
+
+    def __reduce__(self):
+        return self.__qualname__
+
     def __call__(self, *args, **kwargs):
         # Create a new Context and return it.
         ctx = _VSContext(self._f)
@@ -1,6 +1,9 @@
 """
 Common decorators.
 """
+import functools
+import importlib
+
 from vanstein.context import VSWrappedFunction
 
 
@@ -26,6 +29,79 @@ def native_invoke(func):
     return func
 
 
+def suspending(func):
+    """
+    Marks a function as a **suspending native**.
+
+    Suspending natives run inside CPython like :func:`native_invoke` functions, but they are passed the calling
+    :class:`vanstein.context._VSContext` as their first argument (after `self`, for methods).
+
+    They can either return a result straight away, which doesn't switch out of the calling context at all, or call
+    `ctx.suspend()` to park the calling context. A parked context carries on once something calls `ctx.resume(result)`
+    or `ctx.resume_exception(exception)`. If the context might be cancelled while it's parked, pass a callback to
+    `ctx.suspend` that stops whatever would resume it.
+
+    :param func: The function to decorate.
+    :return: A modified function object.
+    """
+    func._native_invoke = True
+    func._vs_suspends = True
+    return func
+
+
+def _resolve_wrapped(module: str, qualname: str):
+    """
+    Finds the function underneath an `in_executor` wrapper, from its module and qualified name.
+    """
+    obj = importlib.import_module(module)
+    for name in qualname.split("."):
+        obj = getattr(obj, name)
+
+    return obj.__wrapped__
+
+
+class _ExecutorFunction(object):
+    """
+    The function underneath an `in_executor` wrapper, as it's passed to the executor.
+
+    The function's name in its module now refers to the wrapper, so the function can't be pickled by reference like a
+    regular function. This is pickled as a reference to the wrapper instead, so it can be sent to a
+    ProcessPoolExecutor.
+    """
+
+    def __init__(self, func: callable):
+        self._f = func
+
+    def __reduce__(self):
+        return _resolve_wrapped, (self._f.__module__, self._f.__qualname__)
+
+    def __call__(self, *args):
+        return self._f(*args)
+
+
+def in_executor(func):
+    """
+    Marks a function to be ran in the **executor** when it's called from VS.
+
+    This is for blocking functions, such as reading files, hashing or compression. Only the calling context is parked
+    while the function runs; every other task carries on running.
+
+    The decorated function can only be called from inside Vanstein. To run it in a ProcessPoolExecutor, it must be
+    defined at the top level of a module.
+
+    :param func: The function to decorate.
+    :return: A new suspending function.
+    """
+    target = _ExecutorFunction(func)
+
+    @functools.wraps(func)
+    def wrapper(ctx, *args):
+        from vanstein.loop import get_running_loop
+        get_running_loop().run_in_executor(ctx, target, *args)
+
+    return suspending(wrapper)
+
+
 def async_func(func):
     """
     Marks a function for **Vanstein execution.**
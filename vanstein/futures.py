@@ -0,0 +1,149 @@
+"""
+Futures, for sharing one result between many contexts.
+"""
+import functools
+
+from vanstein.context import _VSContext, VSCtxState, NO_RESULT, run_callbacks
+from vanstein.decorators import native_invoke, suspending
+
+
+class Future(object):
+    """
+    A result that will be available later.
+
+    Any number of contexts can wait on a future with `wait()`, and all of them are woken up when it is done.
+    """
+
+    def __init__(self):
+        # This is PENDING until a result or an exception is set; then FINISHED or ERRORED.
+        self.state = VSCtxState.PENDING
+
+        self._result = NO_RESULT
+        self._exception = None
+
+        # The callbacks to call with this future when it's done.
+        self._callbacks = []
+
+    def __repr__(self):
+        return "<{} state={}>".format(type(self).__name__, self.state)
+
+    @native_invoke
+    def done(self) -> bool:
+        """
+        :return: If the future has a result or an exception.
+        """
+        return self.state is not VSCtxState.PENDING
+
+    @native_invoke
+    def result(self):
+        """
+        :return: The result of the future.
+            If the future has an exception, it is raised instead.
+        """
+        if self.state is VSCtxState.PENDING:
+            raise RuntimeError("Future is not done")
+
+        if self._exception is not None:
+            raise self._exception
+
+        return self._result
+
+    @native_invoke
+    def exception(self) -> BaseException:
+        """
+        :return: The exception of the future, or None if it doesn't have one.
+        """
+        if self.state is VSCtxState.PENDING:
+            raise RuntimeError("Future is not done")
+
+        return self._exception
+
+    @native_invoke
+    def add_done_callback(self, callback: callable):
+        """
+        Adds a callback to be called with this future once it's done.
+
+        If the future is already done, the callback is called straight away.
+        """
+        if self.state is not VSCtxState.PENDING:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    @native_invoke
+    def remove_done_callback(self, callback: callable) -> int:
+        """
+        Removes every instance of a callback.
+
+        :return: The number of callbacks removed.
+        """
+        before = len(self._callbacks)
+        self._callbacks = [cb for cb in self._callbacks if cb != callback]
+        return before - len(self._callbacks)
+
+    def _finish(self, state: VSCtxState):
+        self.state = state
+        callbacks, self._callbacks = self._callbacks, []
+        run_callbacks(callbacks, self)
+
+    @native_invoke
+    def set_result(self, result):
+        """
+        Sets the result of the future, and wakes up everything waiting on it.
+        """
+        if self.state is not VSCtxState.PENDING:
+            raise RuntimeError("Future is already done")
+
+        self._result = result
+        self._finish(VSCtxState.FINISHED)
+
+    @native_invoke
+    def set_exception(self, exception: BaseException):
+        """
+        Sets the exception of the future, and wakes up everything waiting on it.
+        """
+        if self.state is not VSCtxState.PENDING:
+            raise RuntimeError("Future is already done")
+
+        self._exception = exception
+        self._finish(VSCtxState.ERRORED)
+
+    @suspending
+    def wait(self, ctx: _VSContext):
+        """
+        Parks the calling context until the future is done.
+
+        :return: The result of the future.
+            If the future has an exception, it is raised instead.
+        """
+        if self.state is not VSCtxState.PENDING:
+            return self.result()
+
+        callback = functools.partial(_wake_waiter, ctx)
+        self._callbacks.append(callback)
+        ctx.suspend(functools.partial(self._callbacks.remove, callback))
+
+
+def _wake_waiter(ctx: _VSContext, future: Future):
+    if future._exception is not None:
+        ctx.resume_exception(future._exception)
+    else:
+        ctx.resume(future._result)
+
+
+class Task(Future):
+    """
+    A future for the result of a context.
+    """
+
+    def __init__(self, context: _VSContext):
+        super().__init__()
+        self.context = context
+
+        if context.state is VSCtxState.FINISHED:
+            self.set_result(context.result)
+        elif context.state is VSCtxState.ERRORED:
+            self.set_exception(context._exception_state)
+        else:
+            context.add_done_callback(self.set_result)
+            context.add_exception_callback(self.set_exception)
@@ -0,0 +1,141 @@
+"""
+Process-wide caches for data derived from code objects.
+
+Every context of the same function compiles to exactly the same instructions and jump targets, so this is done once
+per code object and shared between them, instead of once per context.
+"""
+import array
+import collections
+import functools
+import types
+import weakref
+
+try:
+    import dis
+
+    dis.Instruction
+except AttributeError:
+    from vanstein.backports import dis
+
+
+class CodeCache(object):
+    """
+    A bounded cache keyed by code object.
+
+    Code objects are only held weakly, so when a function is garbage collected its entry is dropped with it.
+    Once more than `maxsize` code objects are cached, the least recently used entry is evicted.
+    """
+
+    def __init__(self, factory: callable, maxsize: int = 1024):
+        # The factory is called with a code object to create the value for it.
+        self.factory = factory
+        self.maxsize = maxsize
+
+        # id(code) -> (weakref to code, value)
+        # The weakref is used both to drop entries, and to make sure a re-used id isn't mistaken for a cached one.
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, code: types.CodeType):
+        entry = self._entries.get(id(code))
+        return entry is not None and entry[0]() is code
+
+    def _remove(self, key: int, ref: weakref.ref):
+        # Weakref callback; only remove the entry if it hasn't been replaced since.
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] is ref:
+            self._entries.pop(key, None)
+
+    def get(self, code: types.CodeType):
+        """
+        Gets the cached value for a code object, creating it if it doesn't exist.
+        """
+        key = id(code)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0]() is code:
+            self._entries.move_to_end(key)
+            return entry[1]
+
+        value = self.factory(code)
+        ref = weakref.ref(code, functools.partial(self._remove, key))
+        self._entries[key] = (ref, value)
+        self._entries.move_to_end(key)
+
+        # Evict the oldest entries.
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+        return value
+
+    def clear(self):
+        self._entries.clear()
+
+
+# Opcodes whose argument is the offset of another instruction.
+_JUMP_OPCODES = frozenset(dis.hasjrel) | frozenset(dis.hasjabs)
+
+
+class CompiledCode(object):
+    """
+    The compiled form of a code object, which is what the engine runs.
+
+    This only keeps what is needed to execute, in parallel arrays indexed by instruction.
+    Full `dis.Instruction` objects are only created when needed for debugging.
+
+    This is built once per code object, and shared between every context for it.
+    """
+
+    def __init__(self, code: types.CodeType):
+        # The opcode of each instruction.
+        self.opcodes = array.array("H")
+
+        # The argument of each instruction, or 0 if it doesn't take one.
+        self.args = array.array("i")
+
+        # The index of the instruction each jump instruction jumps to, or -1 if it doesn't jump.
+        self.targets = array.array("i")
+
+        # The bytecode offset of each instruction.
+        self.offsets = array.array("i")
+
+        # The line table.
+        # This is the source line each instruction belongs to, or 0 if it comes before the first line.
+        self.lines = array.array("i")
+
+        instructions = list(dis.get_instructions(code))
+        offset_index = {instruction.offset: n for (n, instruction) in enumerate(instructions)}
+
+        line = 0
+        for instruction in instructions:
+            self.opcodes.append(instruction.opcode)
+            self.args.append(instruction.arg or 0)
+
+            # `argval` is the resolved offset for both relative and absolute jumps.
+            if instruction.opcode in _JUMP_OPCODES:
+                self.targets.append(offset_index[instruction.argval])
+            else:
+                self.targets.append(-1)
+
+            self.offsets.append(instruction.offset)
+
+            if instruction.starts_line:
+                line = instruction.starts_line
+            self.lines.append(line)
+
+    def __len__(self):
+        return len(self.opcodes)
+
+
+# The compiled form of each code object.
+compiled_cache = CodeCache(CompiledCode)
+
+
+def get_compiled(code: types.CodeType) -> CompiledCode:
+    """
+    Gets the compiled form of a code object.
+
+    The returned object is shared between every caller, and must not be modified.
+    """
+    return compiled_cache.get(code)
@@ -0,0 +1,23 @@
+"""
+The threaded-code compiler.
+
+This turns a code object into a list of closures, one per instruction, using the factories in `instructions.py`.
+Each closure has everything its instruction needs (constants, names, varname indexes and jump targets) bound in
+already, so the engine runs an instruction with just `ops[pointer](ctx)`.
+"""
+import types
+
+from vanstein.interpreter.code_cache import get_compiled
+
+
+def compile_threaded(code: types.CodeType, table: list) -> list:
+    """
+    Compiles a code object into a list of instruction closures.
+
+    :param code: The code object to compile.
+    :param table: The opcode -> instruction factory table to compile with.
+    :return: A list of closures, indexed by instruction pointer.
+    """
+    compiled = get_compiled(code)
+    return [table[opcode](code, arg, target)
+            for (opcode, arg, target) in zip(compiled.opcodes, compiled.args, compiled.targets)]
@@ -4,44 +4,203 @@ The engine class actually runs the bytecode.
 
 import dis
 import inspect
+import types
 
-from vanstein.context import _VSContext, VSCtxState, VSWrappedFunction
+from vanstein.context import _VSContext, VSCtxState, VSWrappedFunction, VSSliceStats
 from vanstein.decorators import native_invoke
+from vanstein.metrics import EngineMetrics
 
 from vanstein.interpreter import instructions
+from vanstein.interpreter.code_cache import CodeCache
+from vanstein.interpreter.compiler import compile_threaded
+from vanstein.interpreter.profiler import OpcodeProfiler
 from vanstein.interpreter.vs_exceptions import safe_raise
 
 
+def _not_implemented(opname: str):
+    """
+    Creates the fallback factory for an opcode that has no entry in `instructions.py`.
+
+    This only raises when the instruction is ran, so functions that never reach it still work.
+    """
+
+    def factory(code: types.CodeType, arg: int, target: int):
+        def op(ctx: _VSContext):
+            raise NotImplementedError(opname)
+
+        return op
+
+    return factory
+
+
+# The kinds of call CALL_FUNCTION can make.
+# Run the function natively, inside CPython.
+CALL_NATIVE = 0
+# Call a VSWrappedFunction to get a new context.
+CALL_WRAPPED = 1
+# Wrap a regular function in a new context.
+CALL_PLAIN = 2
+# Run a suspending native function, which gets passed the context.
+CALL_SUSPENDING = 3
+
+
 class VansteinEngine(object):
     """
     The bytecode virtual machine object runs bytecode that is generated by CPython.
     """
 
-    def __init__(self, do_context_switching=True):
-        self.current_instruction: dis.Instruction = None
+    def __init__(self, do_context_switching=True, direct_handoff=True, instruction_budget=None):
+        # The context being ran, or None if the engine isn't running anything.
+        # If a context raised an unexpected error, this is left set to it.
         self.current_context: _VSContext = None
 
-        self.do_context_switching: bool = do_context_switching
+        # If this is False, every function is called natively.
+        # This is read through the `do_context_switching` property, which throws away the threaded code when it
+        # changes, as each call site caches how it classified its callable.
+        self._do_context_switching: bool = do_context_switching
+
+        # If this is True, calling a VS function runs it immediately, and it hands its result straight back to the
+        # caller once it's done, without going through the event loop.
+        # The loop only gets control back when a context reaches a real suspension point.
+        self.direct_handoff: bool = direct_handoff
+
+        # The maximum number of instructions to run in one slice, or None for no limit.
+        # When a slice runs out, the running context is preempted: it is set back to PENDING so the loop can requeue
+        # it, and carries on from exactly where it was next time it runs.
+        # While this is set, each context keeps statistics about its slices in `context.slice_stats`.
+        self.instruction_budget: int = instruction_budget
+
+        # The dispatch table.
+        # This is indexed by the integer opcode of an instruction, and contains the factory that compiles it.
+        self.dispatch_table: list = self._build_dispatch_table()
+
+        # The threaded code for each code object this engine has ran.
+        # This can't be shared between engines, as CALL_FUNCTION is bound to the engine.
+        self.threaded_code: CodeCache = CodeCache(self._compile)
+
+        # The metrics for this engine, or None if they're disabled.
+        self.metrics: EngineMetrics = None
+
+        # The opcode profiler, or None if profiling is disabled.
+        # While this is set, contexts are ran by the profiler instead of by `run_context`'s own loops.
+        self.profiler: OpcodeProfiler = None
+
+    @property
+    def do_context_switching(self) -> bool:
+        return self._do_context_switching
+
+    @do_context_switching.setter
+    def do_context_switching(self, value: bool):
+        if value != self._do_context_switching:
+            self._do_context_switching = value
+            self.threaded_code.clear()
+
+    def enable_profiling(self) -> OpcodeProfiler:
+        """
+        Starts profiling every instruction this engine runs.
+
+        :return: The profiler, which records results in place.
+        """
+        if self.profiler is None:
+            self.profiler = OpcodeProfiler()
+
+        return self.profiler
+
+    def disable_profiling(self) -> OpcodeProfiler:
+        """
+        Stops profiling.
+
+        :return: The profiler, with the results so far.
+        """
+        profiler, self.profiler = self.profiler, None
+        return profiler
+
+    def enable_metrics(self) -> EngineMetrics:
+        """
+        Starts counting metrics for this engine.
+
+        The threaded code is thrown away, so that CALL_FUNCTION is compiled again with counting.
+
+        :return: The metrics, which are updated in place.
+        """
+        if self.metrics is None:
+            self.metrics = EngineMetrics()
+            self.threaded_code.clear()
+
+        return self.metrics
+
+    def disable_metrics(self):
+        """
+        Stops counting metrics for this engine.
+        """
+        if self.metrics is not None:
+            self.metrics = None
+            self.threaded_code.clear()
+
+    def _counted(self, call: callable, *counters: str) -> callable:
+        """
+        Wraps one of the CALL_FUNCTION handlers, to count how many times it's called in each of `counters`.
+        """
+        metrics = self.metrics
+
+        def counted_call(*args):
+            for counter in counters:
+                setattr(metrics, counter, getattr(metrics, counter) + 1)
+            call(*args)
+
+        return counted_call
+
+    def _build_dispatch_table(self) -> list:
+        """
+        Builds the opcode -> instruction factory dispatch table for this engine.
+
+        Every instruction defined in `instructions.py` is looked up once here, instead of once per instruction.
+        Opcodes that do not have a handler raise NotImplementedError when they are reached.
+        """
+        table = [_not_implemented(opname) for opname in dis.opname]
+
+        for opname, opcode in dis.opmap.items():
+            factory = getattr(instructions, opname, None)
+            if factory is not None:
+                table[opcode] = factory
+
+        # CALL_FUNCTION needs access to the engine, so it's a method instead.
+        table[dis.opmap["CALL_FUNCTION"]] = self._compile_call_function
+
+        return table
+
+    def _compile(self, code: types.CodeType) -> list:
+        return compile_threaded(code, self.dispatch_table)
+
+    @property
+    def current_instruction(self) -> dis.Instruction:
+        """
+        The instruction currently being run.
+
+        This creates a full instruction object, so it should only be used for debugging.
+        """
+        if self.current_context is None:
+            return None
+
+        return self.current_context.current_instruction
 
     @native_invoke
-    def __run_natively(self, context: _VSContext, instruction: dis.Instruction):
+    def _call_native(self, context: _VSContext, arg: int):
         """
         Invokes a function natively.
-        """
-        # Get the number of arguments to pop off of the stack.
-        number_of_args = instruction.arg
-        args = []
-        for x in range(0, number_of_args):
-            # Pop each argument off of the stack.
-            args.append(context.stack.pop())
 
-        args = reversed(args)
+        This is the fast path for CALL_FUNCTION; the context stays RUNNING the whole time.
+        """
+        stack = context.stack
+        # Slice the arguments off of the stack in one go.
+        if arg:
+            args = stack[-arg:]
+            del stack[-arg:]
+        else:
+            args = ()
 
         # Now pop the function, which is underneath all the others.
-        fn = context.stack.pop()
-        if not callable(fn):
-            safe_raise(context, TypeError("'{}' object is not callable".format(fn)))
-            return
+        fn = stack.pop()
 
         # Run the function.
         try:
@@ -50,103 +209,294 @@ class VansteinEngine(object):
             safe_raise(context, e)
             return
 
-        return result
+        stack.append(result)
+
+    @native_invoke
+    def _call_suspending(self, context: _VSContext, arg: int):
+        """
+        Invokes a suspending native function.
+
+        This is the same as `_call_native`, except the context is passed to the function, and no result is pushed if
+        the function suspended the context.
+        """
+        stack = context.stack
+        if arg:
+            args = stack[-arg:]
+            del stack[-arg:]
+        else:
+            args = ()
+
+        fn = stack.pop()
+
+        try:
+            result = fn(context, *args)
+        except BaseException as e:
+            safe_raise(context, e)
+            return
+
+        if context.state is VSCtxState.RUNNING:
+            # It didn't need to suspend.
+            stack.append(result)
+
+    def _throw_pending(self, context: _VSContext):
+        """
+        Raises the exception passed to `resume_exception` or `cancel` into a context.
+        """
+        exception, context._pending_exception = context._pending_exception, None
+        safe_raise(context, exception)
+
+    def _classify_callable(self, fn: callable) -> int:
+        """
+        Classifies a callable for CALL_FUNCTION.
+
+        :return: One of CALL_NATIVE, CALL_WRAPPED, CALL_PLAIN or CALL_SUSPENDING.
+        """
+        # method wrappers die
+        if type(fn) is type:
+            fn = fn.__new__
+
+        # Suspending natives always need the context, even without context switching.
+        if hasattr(fn, "_vs_suspends"):
+            return CALL_SUSPENDING
+
+        # First, check if it's a builtin or is a native invoke.
+        # Also, check if we should even do context switching.
+        # Things that aren't callable are "called" natively too, so that they raise the regular TypeError.
+        if inspect.isbuiltin(fn) or hasattr(fn, "_native_invoke") or self.do_context_switching is False \
+                or not callable(fn):
+            return CALL_NATIVE
+
+        if isinstance(fn, VSWrappedFunction):
+            return CALL_WRAPPED
+
+        # Calling a generator or coroutine function only creates the generator, which VS can't run anyway.
+        if inspect.isgeneratorfunction(fn) or inspect.iscoroutinefunction(fn):
+            return CALL_NATIVE
+
+        return CALL_PLAIN
+
+    def _compile_call_function(self, code: types.CodeType, arg: int, target: int):
+        """
+        Compiles CALL_FUNCTION.
+
+        Each call site gets an inline cache of the last callable called there and how it was classified, so the
+        callable is only classified again when a different one is called.
+
+        Builtins are always called natively, so they skip the cache. Builtin bound methods, such as `list.append`
+        looked up on a list, are new objects on every attribute access, so they would never hit it anyway.
+        """
+        call_native = self._call_native
+        call_suspending = self._call_suspending
+        call_function = self._call_function
+        if self.metrics is not None:
+            call_native = self._counted(call_native, "native_calls")
+            call_suspending = self._counted(call_suspending, "suspending_calls")
+            # Every VS call creates a new context.
+            call_function = self._counted(call_function, "vs_calls", "contexts_created")
+
+        classify = self._classify_callable
+        method_type = types.MethodType
+        builtin_type = types.BuiltinFunctionType
+
+        # [callable, kind]
+        site = [None, None]
+
+        def op(ctx: _VSContext):
+            # Get STACK[-arg]
+            # CALL_FUNCTION(arg) => arg is number of positional arguments to use, so pop that off of the stack.
+            fn = ctx.stack[-(arg + 1)]
+            if type(fn) is builtin_type:
+                call_native(ctx, arg)
+                return
+
+            # Bound methods are created on every attribute access, so cache by the function underneath.
+            key = fn.__func__ if type(fn) is method_type else fn
+            if key is not site[0]:
+                site[0] = key
+                site[1] = classify(fn)
+
+            if site[1] == CALL_NATIVE:
+                call_native(ctx, arg)
+            elif site[1] == CALL_SUSPENDING:
+                call_suspending(ctx, arg)
+            else:
+                call_function(ctx, arg, site[1])
+
+        return op
+
+    @native_invoke
+    def _call_function(self, context: _VSContext, arg: int, kind: int):
+        """
+        Handler for CALL_FUNCTION, when calling a function that runs inside VS.
+
+        This creates a new context for the function and suspends the current context.
+        The new context is stored in `context.next_ctx`.
+
+        :param kind: The classification of the function being called, from `_classify_callable`.
+        """
+        # We need to context switch, so suspend this current one.
+        context.state = VSCtxState.SUSPENDED
+
+        # Here's some context switching.
+        bottom_of_stack = context.stack[-(arg + 1)]
+        if kind == CALL_WRAPPED:
+            # Call the VSWrappedFunction to get a new context.
+            # We'll manually fill these args.
+            new_ctx = bottom_of_stack()
+
+        else:
+            # Wrap the function in a context.
+            new_ctx = _VSContext(bottom_of_stack)
+
+        # Set the previous context, for stack frame chaining.
+        new_ctx.prev_ctx = context
+        new_ctx._engine = self
+        # Doubly linked list!
+        context.next_ctx = new_ctx
+        # Set the new state to PENDING so it knows to run it on the next run.
+        new_ctx.state = VSCtxState.PENDING
+
+        # Add a callback to the new context.
+        # This is so the loop can schedule execution of the new context soon.
+        new_ctx.add_done_callback(context._on_result_cb)
+        new_ctx.add_exception_callback(context._on_exception_cb)
+
+        # Fill the number of arguments the function call requests.
+        stack = context.stack
+        if arg:
+            new_ctx.fill_args(*stack[-arg:])
+            # Pop the arguments and the function object off, too.
+            del stack[-(arg + 1):]
+        else:
+            stack.pop()
+
+        return new_ctx
 
     @native_invoke
     def run_context(self, context: _VSContext) -> _VSContext:
         """
         Runs the current bytecode for a context.
 
-        This will instructions off of the instruction stack, until it reaches a context switch.
+        This will run instructions off of the instruction stack, until it reaches a context switch.
+
+        With direct handoff, a context switch into a new context runs it straight away, and when that finishes (or
+        errors) its caller is resumed straight away if it has been woken up.
+
+        :return: The context that was running when execution stopped.
+            If it is SUSPENDED, `next_ctx` is the context it is waiting on.
         """
         # Welcome to the main bulk of Vanstein.
         # Enjoy your stay!
+        running = VSCtxState.RUNNING
+        budget = self.instruction_budget
+        remaining = budget
+        metrics = self.metrics
+        profiler = self.profiler
 
-        # Switch to running state for this context.
-        context.state = VSCtxState.RUNNING
-        self.current_context = context
         while True:
-            if context.state is VSCtxState.FINISHED:
+            self.current_context = context
+            if metrics is not None:
+                metrics.context_switches += 1
+
+            # Exceptions raised into the context, and it erroring, are counted by the context itself.
+            context._engine = self
+
+            # It's running, so it's kept whatever it was handed when it was woken up.
+            context._handoff_callback = None
+
+            if context._pending_exception is not None:
+                # It was resumed with an exception, which might mean it can't run at all.
+                self._throw_pending(context)
+
+            # Switch to running state for this context.
+            if context.state is not VSCtxState.ERRORED:
+                context.state = running
+
+            ops = self.threaded_code.get(context.__code__)
+            if profiler is not None:
+                # The profiler has its own loop, so that the others don't pay for it.
+                executed = profiler.run(context, ops, remaining)
+                if budget is not None:
+                    self._record_slice(context, executed)
+                    remaining -= executed
+                if metrics is not None:
+                    metrics.instructions += executed
+            elif budget is None and metrics is None:
+                while context.state is running:
+                    context.instruction_pointer += 1
+                    # Run the instruction.
+                    ops[context.instruction_pointer](context)
+            elif budget is None:
+                # The same as above, but counting instructions.
+                executed = 0
+                while context.state is running:
+                    executed += 1
+                    context.instruction_pointer += 1
+                    ops[context.instruction_pointer](context)
+
+                metrics.instructions += executed
+            else:
+                start = remaining
+                while context.state is running:
+                    if not remaining:
+                        # Out of budget, so preempt the context.
+                        # The loop will requeue it.
+                        context.state = VSCtxState.PENDING
+                        break
+
+                    remaining -= 1
+                    context.instruction_pointer += 1
+                    # Run the instruction.
+                    ops[context.instruction_pointer](context)
+
+                self._record_slice(context, start - remaining)
+                if metrics is not None:
+                    metrics.instructions += start - remaining
+
+            state = context.state
+            if metrics is not None and state is VSCtxState.FINISHED:
+                metrics.contexts_finished += 1
+
+            if state is VSCtxState.FINISHED:
                 # Done after a successful RETURN_VALUE.
-                # Break the loop, and return the context.
+                # This wakes up the caller.
                 context.finish()
-                return context
 
-            if context.state is VSCtxState.ERRORED:
+            if not self.direct_handoff or state is VSCtxState.PENDING:
+                self.current_context = None
                 return context
 
-            next_instruction = context.next_instruction()
-            self.current_instruction = next_instruction
-
-            # First, we check if we need to context switch.
-            # Check if it's CALL_FUNCTION.
-            if next_instruction.opname == "CALL_FUNCTION":
-                # This is the instruction for CALL_FUNCTION. No specialized one exists in the instructions.py file.
-
-                # We need to context switch, so suspend this current one.
-                context.state = VSCtxState.SUSPENDED
-                # Get STACK[-arg]
-                # CALL_FUNCTION(arg) => arg is number of positional arguments to use, so pop that off of the stack.
-                bottom_of_stack = context.stack[-(next_instruction.arg + 1)]
-
-                # method wrappers die
-                if type(bottom_of_stack) is type:
-                    bottom_of_stack = bottom_of_stack.__new__
-
-                # Here's some context switching.
-                # First, check if it's a builtin or is a native invoke.
-                # Also, check if we should even do context switching.
-                if inspect.isbuiltin(bottom_of_stack) or hasattr(bottom_of_stack, "_native_invoke")\
-                        or self.do_context_switching is False:
-                    # Run it!
-                    result = self.__run_natively(context, next_instruction)
-                    # Set the result on the context.
-                    context.state = VSCtxState.RUNNING
-                    # Push the result onto the stack.
-                    context.push(result)
-                    # Continue the loop to the next instruction.
-                    continue
-
-                if isinstance(bottom_of_stack, VSWrappedFunction):
-                    # Call the VSWrappedFunction to get a new context.
-                    # We'll manually fill these args.
-                    new_ctx = bottom_of_stack()
-
-                else:
-                    # Wrap the function in a context.
-                    new_ctx = _VSContext(bottom_of_stack)
-
-                # Set the previous context, for stack frame chaining.
-                new_ctx.prev_ctx = context
-                # Doubly linked list!
-                context.next_ctx = new_ctx
-                # Set the new state to PENDING so it knows to run it on the next run.
-                new_ctx.state = VSCtxState.PENDING
-
-                # Add a callback to the new context.
-                # This is so the loop can schedule execution of the new context soon.
-                new_ctx.add_done_callback(context._on_result_cb)
-                new_ctx.add_exception_callback(context._on_exception_cb)
-
-                # Fill the number of arguments the function call requests.
-                args = []
-                for _ in range(0, next_instruction.arg):
-                    args.append(context.pop())
-
-                args = reversed(args)
-
-                new_ctx.fill_args(*args)
-
-                # Pop the function object off, too.
-                context.pop()
-
-                return new_ctx
-
-            # Else, we run the respective instruction.
-            try:
-                i = getattr(instructions, next_instruction.opname)
-            except AttributeError:
-                raise NotImplementedError(next_instruction.opname)
-
-            # Call the instruction handler.
-            i(context, next_instruction)
+            if state is VSCtxState.SUSPENDED:
+                # CALL_FUNCTION switched out to a new context, so run it now.
+                # If there's no new context, it's waiting on something else, so the loop has to park it.
+                next_ctx = context.next_ctx
+                if next_ctx is None or next_ctx.state is not VSCtxState.PENDING:
+                    self.current_context = None
+                    return context
+                context = next_ctx
+            else:
+                # We've finished or errored, so hand back to the caller if it was woken up by that.
+                # An exception can bubble through several callers before one catches it.
+                prev_ctx = context.prev_ctx
+                while prev_ctx is not None and prev_ctx.state is VSCtxState.ERRORED:
+                    prev_ctx = prev_ctx.prev_ctx
+
+                if prev_ctx is None or prev_ctx.state is not VSCtxState.PENDING:
+                    self.current_context = None
+                    return context
+                context = prev_ctx
+
+    def _record_slice(self, context: _VSContext, instructions: int):
+        """
+        Records a slice of a context that ran with an instruction budget.
+        """
+        stats = context.slice_stats
+        if stats is None:
+            stats = context.slice_stats = VSSliceStats()
+
+        stats.slices += 1
+        stats.instructions += instructions
+        if instructions > stats.max_slice:
+            stats.max_slice = instructions
+        if context.state is VSCtxState.PENDING:
+            stats.preemptions += 1
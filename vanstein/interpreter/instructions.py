@@ -1,179 +1,399 @@
 """
 Welcome to hell!
 
-Each instruction takes two items: the dis.Instruction, and the _VSContext.
-They are responsible for loading everything.
+Each instruction is compiled once per code object, not ran directly.
+They take three items: the code object, the argument of the instruction (0 if it has none), and the index of the
+instruction it jumps to (-1 if it doesn't jump).
+They return a closure that takes the _VSContext, with everything else already loaded.
 """
+import operator
 import types
-import dis
 
 from vanstein.interpreter.vs_exceptions import safe_raise
 from vanstein.context import _VSContext, VSCtxState, NO_RESULT
-from vanstein.util import get_instruction_index_by_offset
 
 
-def LOAD_GLOBAL(ctx: _VSContext, instruction: dis.Instruction):
+def LOAD_GLOBAL(code: types.CodeType, arg: int, target: int):
     """
     Loads a global from `ctx.__globals__`.
     """
-    name = ctx.co_names[instruction.arg]
-    try:
-        item = ctx.get_global(name)
-    except KeyError:
-        # todo: safe_raise
-        return safe_raise(ctx, NameError("name '{}' is not defined".format(name)))
+    name = code.co_names[arg]
 
-    ctx.push(item)
-    return ctx
+    def op(ctx: _VSContext):
+        try:
+            item = ctx.get_global(name)
+        except KeyError:
+            # todo: safe_raise
+            return safe_raise(ctx, NameError("name '{}' is not defined".format(name)))
 
+        ctx.stack.append(item)
 
-def LOAD_CONST(ctx: _VSContext, instruction: dis.Instruction):
+    return op
+
+
+def LOAD_CONST(code: types.CodeType, arg: int, target: int):
     """
-    Loads a const from `ctx.co_consts`.
+    Loads a const from `co_consts`.
     """
-    ctx.push(ctx.co_consts[instruction.arg])
-    return ctx
+    const = code.co_consts[arg]
+
+    def op(ctx: _VSContext):
+        ctx.stack.append(const)
 
+    return op
 
-def LOAD_FAST(ctx: _VSContext, instruction: dis.Instruction):
+
+def LOAD_FAST(code: types.CodeType, arg: int, target: int):
     """
     Loads from VARNAMES.
     """
-    item = ctx.varnames[instruction.arg]
-    if item == NO_RESULT:
-        safe_raise(ctx, NameError("name '{}' is not defined".format(ctx.co_varnames[instruction.arg])))
-        return ctx
-    ctx.push(item)
-    return ctx
+    name = code.co_varnames[arg]
+
+    def op(ctx: _VSContext):
+        item = ctx.varnames[arg]
+        if item is NO_RESULT:
+            safe_raise(ctx, NameError("name '{}' is not defined".format(name)))
+            return
+        ctx.stack.append(item)
+
+    return op
 
 
-def LOAD_NAME(ctx: _VSContext, instruction: dis.Instruction):
+def LOAD_NAME(code: types.CodeType, arg: int, target: int):
     """
     Loads from NAMES.
     """
-    item = ctx.names[instruction.arg]
-    if item == NO_RESULT:
-        safe_raise(ctx, NameError("name '{}' is not defined".format(ctx.co_names[instruction.arg])))
-        return ctx
+    name = code.co_names[arg]
+
+    def op(ctx: _VSContext):
+        item = ctx.names[arg]
+        if item is NO_RESULT:
+            safe_raise(ctx, NameError("name '{}' is not defined".format(name)))
+            return
+
+        ctx.stack.append(item)
+
+    return op
+
+
+def LOAD_ATTR(code: types.CodeType, arg: int, target: int):
+    """
+    Replaces TOS with `getattr(TOS, co_names[arg])`.
+    """
+    name = code.co_names[arg]
+
+    def op(ctx: _VSContext):
+        stack = ctx.stack
+        try:
+            item = getattr(stack.pop(), name)
+        except BaseException as e:
+            safe_raise(ctx, e)
+            return
 
-    ctx.push(item)
-    return ctx
+        stack.append(item)
 
+    return op
 
-def POP_TOP(ctx: _VSContext, instruction: dis.Instruction):
+
+def STORE_ATTR(code: types.CodeType, arg: int, target: int):
+    """
+    Implements `TOS.name = TOS1`.
+    """
+    name = code.co_names[arg]
+
+    def op(ctx: _VSContext):
+        stack = ctx.stack
+        obj = stack.pop()
+        value = stack.pop()
+        try:
+            setattr(obj, name, value)
+        except BaseException as e:
+            safe_raise(ctx, e)
+
+    return op
+
+
+def POP_TOP(code: types.CodeType, arg: int, target: int):
     """
     Pops off the top of the stack.
     """
-    ctx.pop()
-    return ctx
 
+    def op(ctx: _VSContext):
+        ctx.stack.pop()
+
+    return op
 
-def DUP_TOP(ctx: _VSContext, instruction: dis.Instruction):
+
+def DUP_TOP(code: types.CodeType, arg: int, target: int):
     """
     Duplicates the top-most item on the stack.
     """
-    item = ctx.pop()
-    ctx.push(item)
-    ctx.push(item)
-    return ctx
+
+    def op(ctx: _VSContext):
+        ctx.stack.append(ctx.stack[-1])
+
+    return op
 
 
-def STORE_FAST(ctx: _VSContext, instruction: dis.Instruction):
+def STORE_FAST(code: types.CodeType, arg: int, target: int):
     """
     Stores data in co_varnames.
     """
-    ctx.varnames[instruction.arg] = ctx.pop()
-    return ctx
 
+    def op(ctx: _VSContext):
+        ctx.varnames[arg] = ctx.stack.pop()
+
+    return op
+
+
+def STORE_NAME(code: types.CodeType, arg: int, target: int):
+    def op(ctx: _VSContext):
+        ctx.names[arg] = ctx.stack.pop()
 
-def STORE_NAME(ctx: _VSContext, instruction: dis.Instruction):
-    ctx.names[instruction.arg] = ctx.pop()
-    return ctx
+    return op
 
 
-def RETURN_VALUE(ctx: _VSContext, instruction: dis.Instruction):
+def RETURN_VALUE(code: types.CodeType, arg: int, target: int):
     """
     Returns a value.
 
     This will set the state of the context.
     """
-    ctx._result = ctx.pop()
-    ctx.state = VSCtxState.FINISHED
 
-    ctx._handling_exception = False
+    def op(ctx: _VSContext):
+        ctx._result = ctx.stack.pop()
+        ctx.state = VSCtxState.FINISHED
+
+        ctx._handling_exception = False
+
+    return op
+
+
+# region Operators
+# These call straight into the `operator` module, the same as CPython does.
+
+def _unary_op(func: callable):
+    """
+    Creates the factory for an instruction that replaces TOS with `func(TOS)`.
+    """
+
+    def factory(code: types.CodeType, arg: int, target: int):
+        def op(ctx: _VSContext):
+            stack = ctx.stack
+            try:
+                result = func(stack.pop())
+            except BaseException as e:
+                safe_raise(ctx, e)
+                return
+
+            stack.append(result)
+
+        return op
+
+    return factory
+
+
+def _binary_op(func: callable):
+    """
+    Creates the factory for an instruction that replaces TOS1 and TOS with `func(TOS1, TOS)`.
+    """
+
+    def factory(code: types.CodeType, arg: int, target: int):
+        def op(ctx: _VSContext):
+            stack = ctx.stack
+            right = stack.pop()
+            left = stack.pop()
+            try:
+                result = func(left, right)
+            except BaseException as e:
+                safe_raise(ctx, e)
+                return
 
-    return ctx
+            stack.append(result)
 
+        return op
 
-def COMPARE_OP(ctx: _VSContext, instruction: dis.Instruction):
+    return factory
+
+
+UNARY_POSITIVE = _unary_op(operator.pos)
+UNARY_NEGATIVE = _unary_op(operator.neg)
+UNARY_NOT = _unary_op(operator.not_)
+UNARY_INVERT = _unary_op(operator.invert)
+
+BINARY_POWER = _binary_op(operator.pow)
+BINARY_MULTIPLY = _binary_op(operator.mul)
+BINARY_MATRIX_MULTIPLY = _binary_op(operator.matmul)
+BINARY_FLOOR_DIVIDE = _binary_op(operator.floordiv)
+BINARY_TRUE_DIVIDE = _binary_op(operator.truediv)
+BINARY_MODULO = _binary_op(operator.mod)
+BINARY_ADD = _binary_op(operator.add)
+BINARY_SUBTRACT = _binary_op(operator.sub)
+BINARY_SUBSCR = _binary_op(operator.getitem)
+BINARY_LSHIFT = _binary_op(operator.lshift)
+BINARY_RSHIFT = _binary_op(operator.rshift)
+BINARY_AND = _binary_op(operator.and_)
+BINARY_XOR = _binary_op(operator.xor)
+BINARY_OR = _binary_op(operator.or_)
+
+INPLACE_POWER = _binary_op(operator.ipow)
+INPLACE_MULTIPLY = _binary_op(operator.imul)
+INPLACE_MATRIX_MULTIPLY = _binary_op(operator.imatmul)
+INPLACE_FLOOR_DIVIDE = _binary_op(operator.ifloordiv)
+INPLACE_TRUE_DIVIDE = _binary_op(operator.itruediv)
+INPLACE_MODULO = _binary_op(operator.imod)
+INPLACE_ADD = _binary_op(operator.iadd)
+INPLACE_SUBTRACT = _binary_op(operator.isub)
+INPLACE_LSHIFT = _binary_op(operator.ilshift)
+INPLACE_RSHIFT = _binary_op(operator.irshift)
+INPLACE_AND = _binary_op(operator.iand)
+INPLACE_XOR = _binary_op(operator.ixor)
+INPLACE_OR = _binary_op(operator.ior)
+
+# The comparison for each COMPARE_OP argument, in the same order as `dis.cmp_op`.
+# 10 (exception match) is special cased.
+_COMPARISONS = (
+    operator.lt,
+    operator.le,
+    operator.eq,
+    operator.ne,
+    operator.gt,
+    operator.ge,
+    lambda left, right: left in right,
+    lambda left, right: left not in right,
+    operator.is_,
+    operator.is_not,
+)
+
+
+def COMPARE_OP(code: types.CodeType, arg: int, target: int):
     """
     Implements comparison operators.
     """
     # TODO: Rewrite COMPARE_OP into Vanstein-ran function calls.
-    # TODO: Add all of the comparison functions.
-    if instruction.arg == 10:
-        # Pop the too match off.
-        to_match = ctx.pop()
-        # This is what we check.
-        raised = ctx.pop()
+    if arg < len(_COMPARISONS):
+        return _binary_op(_COMPARISONS[arg])(code, arg, target)
 
+    if arg == 10:
         from collections import Iterable
 
-        if not isinstance(to_match, Iterable):
-            to_match = (to_match,)
+        def op(ctx: _VSContext):
+            # Pop the too match off.
+            to_match = ctx.pop()
+            # This is what we check.
+            raised = ctx.pop()
 
-        for e in to_match:
-            # PyType_IsSubType
-            if issubclass(type(raised), e):
-                ctx.push(True)
-                break
-        else:
-            ctx.push(False)
+            if not isinstance(to_match, Iterable):
+                to_match = (to_match,)
+
+            for e in to_match:
+                # PyType_IsSubType
+                if issubclass(type(raised), e):
+                    ctx.push(True)
+                    break
+            else:
+                ctx.push(False)
+
+        return op
+
+    return _nop
 
-    return ctx
+
+# endregion
 
 
 # region jumps
 # Instructions that perform updating of the instruction pointer.
+# The pointer is set to one before the target, as the engine moves the pointer forward before running the next
+# instruction.
 
-def JUMP_FORWARD(ctx: _VSContext, instruction: dis.Instruction):
+def JUMP_FORWARD(code: types.CodeType, arg: int, target: int):
     """
     Jumps forward to the specified instruction.
     """
-    ctx.instruction_pointer = get_instruction_index_by_offset(ctx, instruction)
+    pointer = target - 1
+
+    def op(ctx: _VSContext):
+        ctx.instruction_pointer = pointer
 
-    return ctx
+    return op
 
 
-def POP_JUMP_IF_FALSE(ctx: _VSContext, instruction: dis.Instruction):
+def POP_JUMP_IF_FALSE(code: types.CodeType, arg: int, target: int):
     """
     Jumps to the specified instruction if False-y is on the top of the stack.
     """
-    i = ctx.pop()
-    if i:
-        # Truthy, don't jump.
-        return ctx
+    pointer = target - 1
 
-    # Jump!
-    ctx.instruction_pointer = get_instruction_index_by_offset(ctx, instruction)
+    def op(ctx: _VSContext):
+        if not ctx.stack.pop():
+            # Jump!
+            ctx.instruction_pointer = pointer
 
-    return ctx
+    return op
 
 
-def POP_JUMP_IF_TRUE(ctx: _VSContext, instruction: dis.Instruction):
+def POP_JUMP_IF_TRUE(code: types.CodeType, arg: int, target: int):
     """
     Jumps to the specified instruction if True-y is on the top of the stack.
     """
+    pointer = target - 1
+
+    def op(ctx: _VSContext):
+        if ctx.stack.pop():
+            # Jump, again.
+            ctx.instruction_pointer = pointer
+
+    return op
+
+
+def JUMP_ABSOLUTE(code: types.CodeType, arg: int, target: int):
+    """
+    Jumps to the specified instruction.
+    """
+    pointer = target - 1
+
+    def op(ctx: _VSContext):
+        ctx.instruction_pointer = pointer
+
+    return op
+
+
+# endregion
+
+# region Loops
+
+def GET_ITER(code: types.CodeType, arg: int, target: int):
+    """
+    Replaces TOS with an iterator for it.
+    """
+    return _unary_op(iter)(code, arg, target)
+
+
+def FOR_ITER(code: types.CodeType, arg: int, target: int):
+    """
+    Pushes the next item from the iterator on TOS.
+
+    When the iterator is exhausted, it is popped and this jumps to the end of the loop.
+    """
+    pointer = target - 1
 
-    i = ctx.pop()
-    if not i:
-        # Falsey, stay where we are.
-        return ctx
+    def op(ctx: _VSContext):
+        stack = ctx.stack
+        try:
+            item = next(stack[-1])
+        except StopIteration:
+            stack.pop()
+            ctx.instruction_pointer = pointer
+            return
+        except BaseException as e:
+            stack.pop()
+            safe_raise(ctx, e)
+            return
 
-    # Jump, again.
-    ctx.instruction_pointer = get_instruction_index_by_offset(ctx, instruction)
+        stack.append(item)
 
-    return ctx
+    return op
 
 
 # endregion
@@ -182,8 +402,21 @@ def POP_JUMP_IF_TRUE(ctx: _VSContext, instruction: dis.Instruction):
 # region Stubs
 # Instructions that do nothing currently.
 
-def POP_BLOCK(ctx: _VSContext, instruction: dis.Instruction):
-    return ctx
+def _nop(ctx: _VSContext):
+    pass
+
+
+def POP_BLOCK(code: types.CodeType, arg: int, target: int):
+    return _nop
+
+
+def SETUP_LOOP(code: types.CodeType, arg: int, target: int):
+    return _nop
+
+
+def EXTENDED_ARG(code: types.CodeType, arg: int, target: int):
+    # The extended argument is already folded into the argument of the next instruction.
+    return _nop
 
 
 # endregion
@@ -192,75 +425,83 @@ def POP_BLOCK(ctx: _VSContext, instruction: dis.Instruction):
 # Exception handling.
 # These are all part of the Vanstein bootleg exception system.
 
-def SETUP_EXCEPT(ctx: _VSContext, instruction: dis.Instruction):
+def SETUP_EXCEPT(code: types.CodeType, arg: int, target: int):
     """
     Sets a context up for an except.
     """
-    # Update the exception pointer with the calculated offset.
-    # This is where we will jump to if an error is encountered.
-    ctx.exc_next_pointer = get_instruction_index_by_offset(ctx, instruction)
+    pointer = target - 1
+
+    def op(ctx: _VSContext):
+        # Update the exception pointer with the calculated offset.
+        # This is where we will jump to if an error is encountered.
+        ctx.exc_next_pointer = pointer
 
-    return ctx
+    return op
 
 
-def POP_EXCEPT(ctx: _VSContext, instruction: dis.Instruction):
+def POP_EXCEPT(code: types.CodeType, arg: int, target: int):
     """
     Pops an except block.
     """
-    # Here, we can make several assumptions:
-    # 1) The exception has been handled.
-    # 2) We can empty the exception state.
-    # 3) The function can continue on as normal.
 
-    # This means the exception state is cleared, handling_exception is removed, and it is safe to jump forward as
-    # appropriate.
-    ctx._exception_state = None
-    ctx._handling_exception = False
+    def op(ctx: _VSContext):
+        # Here, we can make several assumptions:
+        # 1) The exception has been handled.
+        # 2) We can empty the exception state.
+        # 3) The function can continue on as normal.
+
+        # This means the exception state is cleared, handling_exception is removed, and it is safe to jump forward as
+        # appropriate.
+        ctx._exception_state = None
+        ctx._handling_exception = False
 
-    # Also, remove the exception pointer.
-    # That way, it won't try to safely handle an exception that happens later on.
-    ctx.exc_next_pointer = None
+        # Also, remove the exception pointer.
+        # That way, it won't try to safely handle an exception that happens later on.
+        ctx.exc_next_pointer = None
 
-    return ctx
+    return op
 
 
-def RAISE_VARARGS(ctx: _VSContext, instruction: dis.Instruction):
+def RAISE_VARARGS(code: types.CodeType, arg: int, target: int):
     """
     Raises an exception to either the current scope or the outer scope.
     """
-    # This is relatively simple.
-    # We ignore the argc == 3, and pretend it's argc == 2
-    argc = instruction.arg
-    if argc == 3:
-        # fuck you
-        ctx.pop()
-        argc = 2
 
-    if argc == 2:
-        # FROM exception is Top of stack now.
-        fr = ctx.pop()
-        # The real exception is top of stack now.
-        exc = ctx.pop()
-        exc.__cause__ = fr
-
-    elif argc == 1:
-        exc = ctx.pop()
-    else:
-        # Bare raise.
-        exc = ctx._exception_state
+    def op(ctx: _VSContext):
+        # This is relatively simple.
+        # We ignore the argc == 3, and pretend it's argc == 2
+        argc = arg
+        if argc == 3:
+            # fuck you
+            ctx.pop()
+            argc = 2
+
+        if argc == 2:
+            # FROM exception is Top of stack now.
+            fr = ctx.pop()
+            # The real exception is top of stack now.
+            exc = ctx.pop()
+            exc.__cause__ = fr
+
+        elif argc == 1:
+            exc = ctx.pop()
+        else:
+            # Bare raise.
+            exc = ctx._exception_state
 
-    # Inject the exception.
-    safe_raise(ctx, exc)
-    # Raise the exception.
+        # Inject the exception.
+        safe_raise(ctx, exc)
+        # Raise the exception.
 
-    return exc
+    return op
 
 
 # endregion
 
-def MAKE_FUNCTION(ctx: _VSContext, instruction: dis.Instruction):
+def MAKE_FUNCTION(code: types.CodeType, arg: int, target: int):
     """
     Called to create a new function.
 
     This assumes a name is on TOS, and that a code object is on TOS2.
     """
+    return _nop
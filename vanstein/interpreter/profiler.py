@@ -0,0 +1,276 @@
+"""
+Profilers for VS code.
+
+The opcode profiler times every instruction the engine runs, so it's much slower than running normally. It's only used
+when it's enabled with `VansteinEngine.enable_profiling`, which makes the engine run contexts through
+`OpcodeProfiler.run` instead of its own loop.
+
+The sampling profiler doesn't slow the engine down at all; it periodically looks at what the engine is running from
+outside of it.
+"""
+import collections
+import json
+import signal
+import threading
+
+try:
+    import dis
+
+    dis.Instruction
+except AttributeError:
+    from vanstein.backports import dis
+
+from vanstein.context import _VSContext, VSCtxState
+from vanstein.interpreter.code_cache import get_compiled
+from vanstein.metrics import clock
+
+
+class OpcodeProfiler(object):
+    """
+    Records how many times each opcode ran and how long it took, both in total and for each instruction of each
+    function.
+
+    The time for CALL_FUNCTION includes the time spent in native functions it calls, but not in VS functions, which
+    run as their own contexts.
+    """
+
+    def __init__(self):
+        # The number of times each opcode ran, and the total seconds it took; indexed by opcode.
+        self.counts = [0] * 256
+        self.times = [0.0] * 256
+
+        # The same, for every instruction of every code object.
+        # {code object: ([count per instruction], [seconds per instruction])}
+        self.instructions = {}
+
+    def __repr__(self):
+        return "<OpcodeProfiler instructions={} seconds={:.6f}>".format(sum(self.counts), sum(self.times))
+
+    def run(self, context: _VSContext, ops: list, limit: int = None) -> int:
+        """
+        Runs a context until it stops running, timing each instruction.
+
+        :param ops: The threaded code for the context.
+        :param limit: The most instructions to run before preempting the context, or None for no limit.
+        :return: The number of instructions ran.
+        """
+        code = context.__code__
+        opcodes = context.compiled.opcodes
+        spots = self.instructions.get(code)
+        if spots is None:
+            spots = self.instructions[code] = ([0] * len(opcodes), [0.0] * len(opcodes))
+
+        counts, times = self.counts, self.times
+        spot_counts, spot_times = spots
+        running = VSCtxState.RUNNING
+        executed = 0
+
+        while context.state is running:
+            if executed == limit:
+                context.state = VSCtxState.PENDING
+                break
+
+            executed += 1
+            context.instruction_pointer += 1
+            ip = context.instruction_pointer
+
+            start = clock()
+            ops[ip](context)
+            elapsed = clock() - start
+
+            opcode = opcodes[ip]
+            counts[opcode] += 1
+            times[opcode] += elapsed
+            spot_counts[ip] += 1
+            spot_times[ip] += elapsed
+
+        return executed
+
+    def clear(self):
+        self.__init__()
+
+    def opcode_stats(self) -> list:
+        """
+        :return: A list of (opname, count, seconds) for every opcode that ran, the slowest in total first.
+        """
+        stats = [(dis.opname[opcode], count, self.times[opcode])
+                 for opcode, count in enumerate(self.counts) if count]
+        stats.sort(key=lambda stat: stat[2], reverse=True)
+        return stats
+
+    def hot_spots(self, limit: int = None) -> list:
+        """
+        :return: A list of (function, filename, line, offset, opname, count, seconds) for every instruction that
+            ran, the slowest in total first.
+        """
+        spots = []
+        for code, (counts, times) in self.instructions.items():
+            compiled = get_compiled(code)
+            for ip, count in enumerate(counts):
+                if count:
+                    spots.append((code.co_name, code.co_filename, compiled.lines[ip], compiled.offsets[ip],
+                                  dis.opname[compiled.opcodes[ip]], count, times[ip]))
+
+        spots.sort(key=lambda spot: spot[6], reverse=True)
+        return spots[:limit]
+
+    def snapshot(self, limit: int = None) -> dict:
+        """
+        :param limit: The most hot spots to include, or None for all of them.
+        :return: The results as a dict of plain values, which can be serialized as JSON.
+        """
+        return {
+            "opcodes": [{"opname": opname, "count": count, "seconds": seconds}
+                        for (opname, count, seconds) in self.opcode_stats()],
+            "hot_spots": [{"function": function, "filename": filename, "line": line, "offset": offset,
+                           "opname": opname, "count": count, "seconds": seconds}
+                          for (function, filename, line, offset, opname, count, seconds) in self.hot_spots(limit)],
+        }
+
+    def dump_json(self, path: str, limit: int = None):
+        """
+        Writes the results to a file as JSON.
+        """
+        with open(path, "w") as f:
+            json.dump(self.snapshot(limit), f, indent=2)
+
+    def report(self, limit: int = 20) -> str:
+        """
+        :param limit: The most opcodes and hot spots to include.
+        :return: The results as a text table, the slowest first.
+        """
+        lines = ["{:<24} {:>12} {:>12} {:>10}".format("opcode", "count", "total ms", "ns/op")]
+        for opname, count, seconds in self.opcode_stats()[:limit]:
+            lines.append("{:<24} {:>12,} {:>12.3f} {:>10.0f}".format(opname, count, seconds * 1000,
+                                                                     seconds / count * 1e9))
+
+        lines.append("")
+        lines.append("{:<40} {:>6} {:<24} {:>12} {:>12}".format("location", "offset", "opcode", "count", "total ms"))
+        for function, filename, line, offset, opname, count, seconds in self.hot_spots(limit):
+            location = "{} ({}:{})".format(function, filename.rsplit("/", 1)[-1], line)
+            lines.append("{:<40} {:>6} {:<24} {:>12,} {:>12.3f}".format(location, offset, opname, count,
+                                                                        seconds * 1000))
+
+        return "\n".join(lines)
+
+
+class SamplingProfiler(object):
+    """
+    Periodically samples the VS call chain of the context an engine is running.
+
+    The samples are aggregated as folded stacks, which flame graph tools such as `flamegraph.pl` and speedscope can
+    read. Each frame is `function:line`, from the outermost caller to the running context.
+
+    Example usage:
+    .. code:: python
+
+        with SamplingProfiler(loop.bytecode_engine) as profiler:
+            loop.run(main())
+
+        profiler.dump("vs.folded")
+    """
+
+    # The most frames sampled from one chain.
+    MAX_DEPTH = 256
+
+    def __init__(self, engine, interval: float = 0.001, use_signal: bool = False):
+        """
+        :param engine: The `VansteinEngine` to sample.
+        :param interval: The number of seconds between samples.
+        :param use_signal: If this is True, samples are taken from a SIGPROF handler every `interval` seconds of CPU
+            time, instead of from a background thread every `interval` seconds of wall time.
+            This is more accurate, but only works on Unix, when the engine runs on the main thread.
+        """
+        self.engine = engine
+        self.interval = interval
+        self.use_signal = use_signal
+
+        # The number of times each folded stack was sampled.
+        self.samples = collections.Counter()
+
+        # The number of samples taken while the engine wasn't running anything.
+        self.idle_samples = 0
+
+        self._thread = None
+        self._stopped = threading.Event()
+        self._previous_handler = None
+
+    def __repr__(self):
+        return "<SamplingProfiler samples={} idle={}>".format(sum(self.samples.values()), self.idle_samples)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def sample(self):
+        """
+        Takes a sample of the engine.
+        """
+        context = self.engine.current_context
+        if context is None:
+            self.idle_samples += 1
+            return
+
+        frames = []
+        try:
+            while context is not None and len(frames) < self.MAX_DEPTH:
+                frames.append("{}:{}".format(context.__code__.co_name, context.f_lineno or 0))
+                context = context.prev_ctx
+        except (AttributeError, IndexError):
+            # The engine moved on while we were looking at it.
+            return
+
+        frames.reverse()
+        self.samples[";".join(frames)] += 1
+
+    def start(self):
+        """
+        Starts sampling.
+        """
+        if self._thread is not None or self._previous_handler is not None:
+            raise RuntimeError("Profiler is already running")
+
+        if self.use_signal:
+            self._previous_handler = signal.signal(signal.SIGPROF, self._on_signal)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        else:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="vanstein-sampler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stops sampling.
+        """
+        if self._previous_handler is not None:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self._previous_handler)
+            self._previous_handler = None
+
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+    def _on_signal(self, signum, frame):
+        self.sample()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+    def folded(self) -> str:
+        """
+        :return: The samples as folded stacks; one `frame;frame;frame count` line per stack.
+        """
+        return "\n".join("{} {}".format(stack, count) for (stack, count) in sorted(self.samples.items()))
+
+    def dump(self, path: str):
+        """
+        Writes the folded stacks to a file.
+        """
+        with open(path, "w") as f:
+            f.write(self.folded() + "\n")
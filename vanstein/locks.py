@@ -0,0 +1,243 @@
+"""
+Synchronization primitives for contexts.
+
+Waiting contexts are parked in FIFO order, and are woken up through the event loop's ready queue.
+None of these switch out of the calling context when they don't have to wait.
+"""
+import collections
+import functools
+
+from vanstein.context import _VSContext
+from vanstein.decorators import native_invoke, suspending
+
+
+class Lock(object):
+    """
+    A mutual exclusion lock.
+
+    When the lock is released with contexts waiting on it, it is handed straight to the first one, so that a context
+    that releases and re-acquires the lock can't jump the queue.
+    """
+
+    def __init__(self):
+        self._locked = False
+
+        # The contexts waiting to acquire the lock.
+        self._waiters = collections.deque()
+
+    def __repr__(self):
+        return "<{} locked={} waiters={}>".format(type(self).__name__, self._locked, len(self._waiters))
+
+    @native_invoke
+    def locked(self) -> bool:
+        return self._locked
+
+    @suspending
+    def acquire(self, ctx: _VSContext):
+        """
+        Acquires the lock, parking the calling context until it is released if it's already held.
+
+        :return: True.
+        """
+        if not self._locked:
+            self._locked = True
+            return True
+
+        self._waiters.append(ctx)
+        ctx.suspend(functools.partial(self._waiters.remove, ctx))
+
+    @native_invoke
+    def release(self):
+        """
+        Releases the lock, handing it to the first waiting context if there is one.
+        """
+        if not self._locked:
+            raise RuntimeError("Lock is not acquired")
+
+        if self._waiters:
+            # The lock stays locked; it now belongs to the waiter.
+            # If the waiter is cancelled before it runs, it releases the lock again.
+            self._waiters.popleft().resume(True, self.release)
+        else:
+            self._locked = False
+
+
+class Semaphore(object):
+    """
+    A semaphore, which lets up to `value` contexts hold it at once.
+    """
+
+    def __init__(self, value: int = 1):
+        if value < 0:
+            raise ValueError("Semaphore initial value must be >= 0")
+
+        self._value = value
+
+        # The contexts waiting to acquire the semaphore.
+        self._waiters = collections.deque()
+
+    def __repr__(self):
+        return "<{} value={} waiters={}>".format(type(self).__name__, self._value, len(self._waiters))
+
+    @native_invoke
+    def locked(self) -> bool:
+        """
+        :return: If `acquire` would park the calling context.
+        """
+        return self._value == 0
+
+    @suspending
+    def acquire(self, ctx: _VSContext):
+        """
+        Acquires the semaphore, parking the calling context until it is released if it's at 0.
+
+        :return: True.
+        """
+        if self._value > 0:
+            self._value -= 1
+            return True
+
+        self._waiters.append(ctx)
+        ctx.suspend(functools.partial(self._waiters.remove, ctx))
+
+    @native_invoke
+    def release(self):
+        """
+        Releases the semaphore, handing it to the first waiting context if there is one.
+        """
+        if self._waiters:
+            self._waiters.popleft().resume(True, self.release)
+        else:
+            self._value += 1
+
+
+class Event(object):
+    """
+    A flag that contexts can wait on being set.
+    """
+
+    def __init__(self):
+        self._flag = False
+
+        # The contexts waiting for the flag to be set.
+        self._waiters = []
+
+    def __repr__(self):
+        return "<{} set={} waiters={}>".format(type(self).__name__, self._flag, len(self._waiters))
+
+    @native_invoke
+    def is_set(self) -> bool:
+        return self._flag
+
+    @native_invoke
+    def set(self):
+        """
+        Sets the flag, waking up every waiting context.
+        """
+        if self._flag:
+            return
+
+        self._flag = True
+        waiters, self._waiters = self._waiters, []
+        for ctx in waiters:
+            ctx.resume(True)
+
+    @native_invoke
+    def clear(self):
+        self._flag = False
+
+    @suspending
+    def wait(self, ctx: _VSContext):
+        """
+        Parks the calling context until the flag is set.
+
+        :return: True.
+        """
+        if self._flag:
+            return True
+
+        self._waiters.append(ctx)
+        ctx.suspend(functools.partial(self._waiters.remove, ctx))
+
+
+class Condition(object):
+    """
+    A condition variable.
+
+    Notified contexts are moved straight onto the lock's wait queue, so that they are woken up once, when the lock is
+    handed to them, rather than once to be notified and again to re-acquire the lock.
+    """
+
+    def __init__(self, lock: Lock = None):
+        if lock is None:
+            lock = Lock()
+
+        self._lock = lock
+
+        # The contexts waiting to be notified.
+        self._waiters = collections.deque()
+
+    def __repr__(self):
+        return "<{} lock={!r} waiters={}>".format(type(self).__name__, self._lock, len(self._waiters))
+
+    @native_invoke
+    def locked(self) -> bool:
+        return self._lock._locked
+
+    @suspending
+    def acquire(self, ctx: _VSContext):
+        """
+        Acquires the underlying lock.
+        """
+        return self._lock.acquire(ctx)
+
+    @native_invoke
+    def release(self):
+        """
+        Releases the underlying lock.
+        """
+        self._lock.release()
+
+    @suspending
+    def wait(self, ctx: _VSContext):
+        """
+        Releases the underlying lock and parks the calling context until it is notified.
+
+        The lock must be held when this is called, and is held again by the time the calling context carries on.
+
+        :return: True.
+        """
+        if not self._lock._locked:
+            raise RuntimeError("Cannot wait on un-acquired lock")
+
+        self._waiters.append(ctx)
+        ctx.suspend(functools.partial(self._cancel_wait, ctx))
+        self._lock.release()
+
+    def _cancel_wait(self, ctx: _VSContext):
+        # The context might have been notified already, and be waiting on the lock instead.
+        # Either way, it no longer holds the lock once it's cancelled.
+        if ctx in self._waiters:
+            self._waiters.remove(ctx)
+        else:
+            self._lock._waiters.remove(ctx)
+
+    @native_invoke
+    def notify(self, n: int = 1):
+        """
+        Wakes up to `n` waiting contexts.
+
+        The lock must be held when this is called; the woken up contexts carry on once they've re-acquired it.
+        """
+        if not self._lock._locked:
+            raise RuntimeError("Cannot notify on un-acquired lock")
+
+        for _ in range(min(n, len(self._waiters))):
+            self._lock._waiters.append(self._waiters.popleft())
+
+    @native_invoke
+    def notify_all(self):
+        """
+        Wakes up every waiting context.
+        """
+        self.notify(len(self._waiters))
@@ -11,8 +11,12 @@ The way the Vanstein event loop works:
        The new function context will be added to the end of the call stack, which will wake up the previous
        function's context.
        Then the loop will pluck the top-most function from the top of the deque, and run it.
+   3c) With direct handoff (the default), the bytecode engine instead runs the new function context straight away,
+       and resumes the previous one as soon as it has a result. The loop only sees a context again once it reaches a
+       real suspension point.
 """
 # This is explicitly called in several places - hijack doesn't always work.
+import selectors
 import threading
 
 try:
@@ -22,6 +26,13 @@ try:
 except AttributeError:
     from vanstein.backports import dis
 
+import concurrent.futures
+import functools
+import heapq
+import itertools
+import json
+import socket
+import time
 import traceback
 import warnings
 from collections import deque
@@ -29,9 +40,9 @@ from collections import deque
 import sys
 
 from vanstein.interpreter.engine import VansteinEngine
-from vanstein.context import _VSContext, VSCtxState
-from vanstein.decorators import native_invoke
-
+from vanstein.context import _VSContext, VSCtxState, VSWrappedFunction
+from vanstein.decorators import native_invoke, suspending
+from vanstein.metrics import LoopMetrics, clock
 
 class LoopLocal(threading.local):
     """
@@ -39,6 +50,37 @@ class LoopLocal(threading.local):
     """
     loop = None  # type: BaseAsyncLoop
 
+    # The loop that is currently running on this thread.
+    running_loop = None  # type: BaseAsyncLoop
+
+
+_local = LoopLocal()
+
+
+class TimerHandle(object):
+    """
+    A callback scheduled to run at a certain time.
+
+    This is returned from `call_later` and `call_at`.
+    """
+
+    def __init__(self, when: float, callback: callable, args: tuple):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Cancels the callback, if it hasn't ran yet.
+        """
+        self.cancelled = True
+        self.callback = None
+        self.args = None
+
+    def __repr__(self):
+        return "<TimerHandle when={} callback={} cancelled={}>".format(self.when, self.callback, self.cancelled)
+
 
 class BaseAsyncLoop(object):
     """
@@ -47,7 +89,13 @@ class BaseAsyncLoop(object):
     This implements everything that is required.
     """
 
-    def __init__(self):
+    def __init__(self, executor_workers: int = None, executor_queue_depth: int = None):
+        """
+        :param executor_workers: The number of threads in the default executor.
+            None uses the `concurrent.futures.ThreadPoolExecutor` default.
+        :param executor_queue_depth: The most jobs that can be queued on the executor at once.
+            Contexts that submit more than this wait their turn. None means there is no limit.
+        """
         self._closed = False
 
         self._running = False
@@ -56,39 +104,116 @@ class BaseAsyncLoop(object):
         # They are popped from the left and added to the right.
         self.running_tasks = deque()
 
+        # This set stores the tasks that are SUSPENDED, waiting on something else.
+        # They are moved back onto `running_tasks` when they are woken up.
+        self.suspended_tasks = set()
+
         # This is the current bytecode engine.
         # This is used to run the actual bytecode used by VS.
         self.bytecode_engine = VansteinEngine()
 
+        # The timers.
+        # This is a heap of (when, sequence, TimerHandle), so the nearest deadline is always first.
+        # The sequence number keeps timers with the same deadline in the order they were added.
+        self._timers = []
+        self._timer_sequence = itertools.count()
+
+        # The I/O reactor.
+        # Each registered file object has a dict of {event: context} for the contexts waiting on it.
+        self.selector = selectors.DefaultSelector()
+
+        # Callbacks scheduled from other threads, which are ran on the loop's thread.
+        # Appending to and popping from a deque are atomic, so this doesn't need a lock.
+        self._threadsafe_callbacks = deque()
+
+        # The self-pipe used to wake the loop up when a callback is scheduled from another thread.
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+        self.selector.register(self._wakeup_reader, selectors.EVENT_READ, None)
+
+        # If the self-pipe has been written to since the loop last drained it.
+        # While this is set, other threads don't need to write to it again.
+        self._wakeup_pending = False
+
+        # The executor used to run blocking functions.
+        # This is created the first time it's needed, unless one is set with `set_default_executor`.
+        self._executor = None
+        self.executor_workers = executor_workers
+        self.executor_queue_depth = executor_queue_depth
+
+        # The number of jobs currently submitted to the executor.
+        self._executor_jobs = 0
+        # The jobs waiting for room on the executor; [context, fn, args].
+        self._executor_backlog = deque()
+
+        # The metrics for this loop, or None if they're disabled.
+        self.metrics: LoopMetrics = None
+
+        # The periodic stats dump; [path, interval, next dump time], or None.
+        self._stats_dump = None
+
     # Note: Nearly all functions inside the loop are native-invoke.
     # Why? Because running a copy of VS inside VS is a horribly wrong process.
     # As such, attempts to run this inside itself will be met with failure, and will just natively invoke.
 
+    @native_invoke
+    def _ready(self, context: _VSContext):
+        """Puts a task on the ready queue."""
+        if self.metrics is not None:
+            context._ready_at = clock()
+        self.running_tasks.append(context)
+
+    @native_invoke
+    def _park(self, context: _VSContext):
+        """Parks a SUSPENDED task until it is woken up."""
+        self.suspended_tasks.add(context)
+        context.add_wakeup_callback(self._wake)
+
+    @native_invoke
+    def _wake(self, context: _VSContext):
+        """Wakeup callback for parked tasks."""
+        self.suspended_tasks.discard(context)
+        if context.state is VSCtxState.PENDING:
+            self._ready(context)
+
     @native_invoke
     def _start_execution(self, context: _VSContext):
         """Begins execution of a task."""
-        new_ctx = self.bytecode_engine.run_context(context)
-
-        # Misuse by reference passing.
-        if new_ctx is not None:
-            # Add it to the end of the deque.
-            self.running_tasks.append(new_ctx)
-            # Add the old task, too.
-            self.running_tasks.append(context)
-            return
+        # This is the context that was running when the engine stopped, which isn't always the one we started.
+        last_ctx = self.bytecode_engine.run_context(context)
 
         # Check the return value of the current context.
-        if context.state is VSCtxState.FINISHED:
+        if last_ctx.state is VSCtxState.SUSPENDED:
+            # It's switched out to a new context.
+            new_ctx = last_ctx.next_ctx
+            if new_ctx is not None and new_ctx.state is VSCtxState.PENDING:
+                # Add it to the end of the deque.
+                self._ready(new_ctx)
+            # Park the old task until it's woken up.
+            self._park(last_ctx)
+        elif last_ctx.state is VSCtxState.PENDING:
+            # Add it to the end of the deque again.
+            self._ready(last_ctx)
+        elif last_ctx.state in [VSCtxState.FINISHED, VSCtxState.ERRORED]:
             # Disappear the context.
+            # If it had a caller, it's already been woken up.
             return
-        elif context.state in [VSCtxState.SUSPENDED, VSCtxState.PENDING]:
-            # Add it to the end of the deque again.
-            self.running_tasks.append(context)
-        elif context.state is VSCtxState.ERRORED:
-            pass
         else:
             warnings.warn("Caught running context - this is not good!")
-            self.running_tasks.append(context)
+            self._ready(last_ctx)
+
+    def _start_execution_timed(self, context: _VSContext):
+        """The same as `_start_execution`, but recording metrics."""
+        metrics = self.metrics
+        start = clock()
+        metrics.steps += 1
+        if context._ready_at is not None:
+            metrics.ready_latency.record(start - context._ready_at)
+            context._ready_at = None
+
+        self._start_execution(context)
+        metrics.slice_duration.record(clock() - start)
 
     @native_invoke
     def _step(self):
@@ -109,8 +234,8 @@ class BaseAsyncLoop(object):
         next_task = self.running_tasks.popleft()
         assert isinstance(next_task, _VSContext)
         if next_task.state is VSCtxState.SUSPENDED:
-            # It hasn't reached a wake-up call yet, so re-add it to the end of the deque.
-            self.running_tasks.append(next_task)
+            # It hasn't reached a wake-up call yet, so park it.
+            self._park(next_task)
             return
 
         if next_task.state == VSCtxState.RUNNING:
@@ -122,6 +247,8 @@ class BaseAsyncLoop(object):
             # It's newly created, or otherwise ready. Continue execution.
             # This should automatically pop or push it as appropriate.
             try:
+                if self.metrics is not None:
+                    return self._start_execution_timed(next_task)
                 return self._start_execution(next_task)
             except NotImplementedError as e:
                 print("Fatal error in Vanstein:")
@@ -146,40 +273,356 @@ class BaseAsyncLoop(object):
             warnings.warn("Reached FINISHED task in event loop...")
             return next_task
 
+    @native_invoke
+    def wait_io(self, context: _VSContext, fileobj, event: int):
+        """
+        Parks a context until a file object is ready.
+
+        :param context: The context to park.
+        :param fileobj: The file object (or file descriptor) to wait on.
+        :param event: Either `selectors.EVENT_READ` or `selectors.EVENT_WRITE`.
+        """
+        try:
+            key = self.selector.get_key(fileobj)
+        except KeyError:
+            self.selector.register(fileobj, event, {event: context})
+        else:
+            if event in key.data:
+                raise RuntimeError("Another context is already waiting on {!r} for this event".format(fileobj))
+            key.data[event] = context
+            self.selector.modify(fileobj, key.events | event, key.data)
+
+        context.suspend(functools.partial(self._stop_waiting_io, fileobj, event))
+
+    def _stop_waiting_io(self, fileobj, event: int):
+        """
+        Stops waiting for an event on a file object, once nobody is waiting on it any more.
+        """
+        key = self.selector.get_key(fileobj)
+        waiters = key.data
+        waiters.pop(event, None)
+
+        # Stop watching for the events nobody is waiting on any more.
+        remaining = 0
+        for event in waiters:
+            remaining |= event
+
+        if remaining:
+            self.selector.modify(fileobj, remaining, waiters)
+        else:
+            self.selector.unregister(fileobj)
+
+    def time(self) -> float:
+        """
+        :return: The current time, according to the loop's clock.
+        """
+        return time.monotonic()
+
+    @native_invoke
+    def call_at(self, when: float, callback: callable, *args) -> TimerHandle:
+        """
+        Schedules a callback to be called at a certain time.
+
+        :param when: The time to call it at, according to `time()`.
+        :param callback: The callback to call. This runs natively.
+        :return: A TimerHandle, which can be used to cancel the callback.
+        """
+        handle = TimerHandle(when, callback, args)
+        heapq.heappush(self._timers, (when, next(self._timer_sequence), handle))
+        return handle
+
+    @native_invoke
+    def call_later(self, delay: float, callback: callable, *args) -> TimerHandle:
+        """
+        Schedules a callback to be called after a delay.
+
+        :param delay: The number of seconds to wait.
+        :param callback: The callback to call. This runs natively.
+        :return: A TimerHandle, which can be used to cancel the callback.
+        """
+        return self.call_at(self.time() + delay, callback, *args)
+
+    @native_invoke
+    def set_default_executor(self, executor: concurrent.futures.Executor):
+        """
+        Sets the executor used by `run_in_executor`.
+
+        This can be any `concurrent.futures.Executor`, such as a ProcessPoolExecutor.
+        """
+        self._executor = executor
+
+    def _get_executor(self) -> concurrent.futures.Executor:
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(self.executor_workers)
+
+        return self._executor
+
+    @native_invoke
+    def run_in_executor(self, context: _VSContext, fn: callable, *args):
+        """
+        Runs a blocking function in the executor, and parks a context until it's done.
+
+        The context is resumed with the return value of the function, or the exception it raised.
+
+        :param context: The context to park.
+        :param fn: The function to run. This runs natively, in another thread (or process).
+        """
+        job = [context, fn, args]
+        if self.executor_queue_depth is not None and self._executor_jobs >= self.executor_queue_depth:
+            # The executor is full, so wait for a job to finish.
+            self._executor_backlog.append(job)
+        else:
+            self._submit_to_executor(job)
+
+        context.suspend(functools.partial(self._cancel_executor_job, job))
+
+    def _submit_to_executor(self, job: list):
+        self._executor_jobs += 1
+        future = self._get_executor().submit(job[1], *job[2])
+        # This is called from the executor's thread.
+        future.add_done_callback(functools.partial(self.call_soon_threadsafe, self._finish_executor_job, job))
+
+    def _cancel_executor_job(self, job: list):
+        for index, queued in enumerate(self._executor_backlog):
+            if queued is job:
+                # It hasn't started yet, so it never has to.
+                del self._executor_backlog[index]
+                return
+
+        # It's already running, and can't be stopped; just throw its result away.
+        job[0] = None
+
+    @native_invoke
+    def _finish_executor_job(self, job: list, future: concurrent.futures.Future):
+        self._executor_jobs -= 1
+        if self._executor_backlog:
+            self._submit_to_executor(self._executor_backlog.popleft())
+
+        context = job[0]
+        if context is None:
+            # The context was cancelled.
+            return
+
+        try:
+            result = future.result()
+        except BaseException as e:
+            context.resume_exception(e)
+        else:
+            context.resume(result)
+
+    def _next_deadline(self) -> float:
+        """
+        :return: The time the nearest timer is due, or None if there are no timers.
+        """
+        timers = self._timers
+        # Throw away any cancelled timers, so they can't keep the loop waiting.
+        while timers and timers[0][2].cancelled:
+            heapq.heappop(timers)
+
+        if not timers:
+            return None
+
+        return timers[0][0]
+
+    @native_invoke
+    def _run_timers(self):
+        """
+        Runs every timer that is due.
+        """
+        now = self.time()
+        timers = self._timers
+        while timers and timers[0][0] <= now:
+            handle = heapq.heappop(timers)[2]
+            if not handle.cancelled:
+                handle.callback(*handle.args)
+
+    def call_soon_threadsafe(self, callback: callable, *args):
+        """
+        Schedules a callback to be ran on the loop's thread, from any thread.
+
+        If the loop is blocked waiting for events, it is woken up straight away.
+
+        :param callback: The callback to call. This runs natively.
+        """
+        if self._closed:
+            raise RuntimeError("Loop is closed")
+
+        self._threadsafe_callbacks.append((callback, args))
+        if self._wakeup_pending:
+            # The loop hasn't drained the self-pipe since it was last written to, so it's going to wake up anyway.
+            return
+
+        self._wakeup_pending = True
+        try:
+            self._wakeup_writer.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            # The pipe is full, so the loop is going to wake up anyway.
+            pass
+
+    def submit_threadsafe(self, function, *args) -> concurrent.futures.Future:
+        """
+        Spawns a context on the loop, from any thread.
+
+        :param function: A context, or a function to create a new context for with `args`.
+        :return: A `concurrent.futures.Future` for the result of the context.
+            Cancelling the future before the context has been spawned stops it from being spawned.
+        """
+        future = concurrent.futures.Future()
+
+        def submit():
+            if not future.set_running_or_notify_cancel():
+                return
+
+            try:
+                context = self.spawn(function, *args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                context.add_done_callback(future.set_result)
+                context.add_exception_callback(future.set_exception)
+
+        self.call_soon_threadsafe(submit)
+        return future
+
+    @native_invoke
+    def _run_threadsafe_callbacks(self):
+        """
+        Runs the callbacks scheduled from other threads.
+        """
+        callbacks = self._threadsafe_callbacks
+        while callbacks:
+            callback, args = callbacks.popleft()
+            callback(*args)
+
+    def _has_events(self) -> bool:
+        """
+        :return: If any contexts are waiting on events, or on jobs running in other threads.
+        """
+        # The self-pipe is always registered.
+        registered = len(self.selector.get_map()) - 1
+
+        return registered > 0 or self._executor_jobs > 0 or bool(self._threadsafe_callbacks)
+
+    @native_invoke
+    def _process_events(self, timeout: float = None):
+        """
+        Checks for events, and wakes up the contexts waiting on them.
+
+        :param timeout: The longest time to block for, or None to block until there is an event.
+        """
+        # The self-pipe is always registered, so this wakes up as soon as another thread schedules a callback.
+        for key, events in self.selector.select(timeout):
+            if key.fileobj is self._wakeup_reader:
+                # Drain the self-pipe; the callbacks themselves are ran afterwards.
+                # The flag is cleared first, so a callback scheduled while draining either writes again, or is ran.
+                self._wakeup_pending = False
+                try:
+                    while self._wakeup_reader.recv(4096):
+                        pass
+                except (BlockingIOError, InterruptedError):
+                    pass
+                continue
+
+            waiters = key.data
+            for event in (selectors.EVENT_READ, selectors.EVENT_WRITE):
+                if events & event and event in waiters:
+                    context = waiters[event]
+                    self._stop_waiting_io(key.fileobj, event)
+                    context.resume()
+
     @native_invoke
     def run_forever(self):
         """
         Runs the event loop forever.
+
+        This runs until there are no tasks left to run, or waiting on events or timers.
+        """
+        self._run_rounds()
+
+    def _run_round(self, block: bool = True, waiting: callable = None, wait_for_threads: bool = False) -> bool:
         """
-        while self.running_tasks:
+        Runs one round of the event loop.
+
+        :param block: If this is False, this never blocks waiting for events or timers.
+        :param waiting: If this is passed, and there is nothing left to do, it is checked to see if any contexts are
+            still waiting on something. If they are, this raises RuntimeError instead of returning False.
+        :param wait_for_threads: If this is True, this blocks until another thread wakes the loop up with
+            `call_soon_threadsafe`, instead of raising RuntimeError.
+        :return: False if there was nothing left to do.
+        """
+        # Run every task that was ready at the start of this round.
+        for _ in range(len(self.running_tasks)):
             self._step()
 
-            # TODO: Check events.
+        deadline = self._next_deadline()
+        if not self.running_tasks and deadline is None and not self._has_events():
+            if waiting is None or not waiting():
+                # Nothing left to do.
+                return False
 
-    @native_invoke
-    def run(self, function: _VSContext):
+            # Nothing on this loop can wake anything up any more; only another thread can.
+            if not wait_for_threads:
+                raise RuntimeError("Deadlock: contexts are still waiting, but there is nothing left to wake them up")
+
+            # The self-pipe is always registered, so this blocks until another thread wakes us up.
+
+        # Check events.
+        # This only blocks if there's nothing else ready to run, and only until the nearest timer is due.
+        if not block or self.running_tasks or self._threadsafe_callbacks:
+            timeout = 0
+        elif deadline is not None:
+            timeout = max(0, deadline - self.time())
+        else:
+            timeout = None
+
+        self._process_events(timeout)
+        self._run_threadsafe_callbacks()
+        self._run_timers()
+
+        if self._stats_dump is not None and self.time() >= self._stats_dump[2]:
+            self._dump_stats()
+
+        return True
+
+    def _run_rounds(self, until: callable = None, waiting: callable = None, wait_for_threads: bool = False):
         """
-        The main entry point into the event loop.
+        Runs the event loop.
 
-        This will begin running your context.
+        :param until: If this is passed, it is checked before each round, and the loop stops once it returns True.
+        :param waiting: If this is passed, and it returns True once the loop has nothing left to do, the loop is
+            deadlocked; see `_run_round`.
+        """
+        while until is None or not until():
+            if not self._run_round(waiting=waiting, wait_for_threads=wait_for_threads):
+                return
+
+    def _run_loop(self, until: callable = None, once: bool = False, waiting: callable = None,
+                  wait_for_threads: bool = False):
+        """
+        :param once: If this is True, only one round is ran, without blocking.
+            This is used to drive the loop from inside another event loop.
         """
         if self._running:
             raise RuntimeError("Loop is already running")
         if self._closed:
             raise RuntimeError("Loop is closed")
-        # Place it onto the task queue.
-        if not isinstance(function, _VSContext):
-            raise TypeError("Function must be a _VSContext")
-        self.running_tasks.append(function)
 
         self._running = True
+        previous_loop, _local.running_loop = _local.running_loop, self
 
-        # We still have a reference, so run_forever.
         try:
-            self.run_forever()
+            if once:
+                if not self._run_round(block=False):
+                    # There's nothing to do, but drain the self-pipe anyway; a stray wakeup left in it would keep the
+                    # selector readable, and the driving loop would keep running rounds.
+                    self._process_events(0)
+            else:
+                self._run_rounds(until, waiting, wait_for_threads)
         finally:
             self._running = False
+            _local.running_loop = previous_loop
 
+    def _get_result(self, function: _VSContext):
         if function.state is VSCtxState.ERRORED:
             traceback.print_exception(type(function._exception_state),
                                       function._exception_state,
@@ -192,18 +635,371 @@ class BaseAsyncLoop(object):
         # If we can, return the result of the function.
         return function.result
 
+    @native_invoke
+    def run(self, function: _VSContext, wait_for_threads: bool = False):
+        """
+        The main entry point into the event loop.
+
+        This will begin running your context.
+
+        :param wait_for_threads: If the context is left waiting on something that nothing on the loop can wake it up
+            from, such as a Future that another thread sets with `call_soon_threadsafe`, this makes the loop block
+            until another thread wakes it up. Otherwise, the loop is deadlocked, and this raises RuntimeError.
+        """
+        if self._running:
+            raise RuntimeError("Loop is already running")
+        if self._closed:
+            raise RuntimeError("Loop is closed")
+        # Place it onto the task queue.
+        if not isinstance(function, _VSContext):
+            raise TypeError("Function must be a _VSContext")
+        self.spawn(function)
+
+        # We still have a reference, so run_forever.
+        self._run_loop(waiting=lambda: function.state not in (VSCtxState.FINISHED, VSCtxState.ERRORED),
+                       wait_for_threads=wait_for_threads)
+
+        return self._get_result(function)
+
+    @native_invoke
+    def run_until_complete(self, *contexts: _VSContext, wait_for_threads: bool = False) -> list:
+        """
+        Runs many contexts at once, until all of them have completed.
+
+        Anything else that has been spawned keeps its place in the loop, and carries on running next time the loop
+        runs.
+
+        :param wait_for_threads: The same as for `run`.
+
+        :return: A list of the result of each context.
+        """
+        for context in contexts:
+            if not isinstance(context, _VSContext):
+                raise TypeError("Function must be a _VSContext")
+        for context in contexts:
+            self.spawn(context)
+
+        # The contexts that haven't completed yet.
+        # These are checked from the end, so each context is only checked until it's completed.
+        pending = list(reversed(contexts))
+
+        def completed():
+            while pending and pending[-1].state in (VSCtxState.FINISHED, VSCtxState.ERRORED):
+                pending.pop()
+            return not pending
+
+        self._run_loop(until=completed, waiting=lambda: not completed(), wait_for_threads=wait_for_threads)
+
+        return [self._get_result(context) for context in contexts]
+
+    @native_invoke
+    def spawn(self, function, *args) -> _VSContext:
+        """
+        Schedules a context to run concurrently with everything else on the loop.
+
+        :param function: A context, or a function to create a new context for with `args`.
+        :return: The context.
+        """
+        if self._closed:
+            raise RuntimeError("Loop is closed")
+
+        if isinstance(function, _VSContext):
+            if args:
+                raise TypeError("Cannot pass arguments with a context")
+            context = function
+        elif isinstance(function, VSWrappedFunction):
+            context = function(*args)
+        else:
+            context = _VSContext(function).fill_args(*args)
+
+        if self.bytecode_engine.metrics is not None:
+            self.bytecode_engine.metrics.contexts_created += 1
+
+        self._ready(context)
+        return context
+
+    @native_invoke
+    def gather(self, context: _VSContext, *contexts: _VSContext):
+        """
+        Parks a context until a number of other contexts have completed.
+
+        The other contexts must already be running, or be spawned.
+        The context is resumed with a list of their results, or the first exception any of them raised.
+
+        :param context: The context to park.
+        :return: The list of results, if every context has already completed.
+        """
+        results = [None] * len(contexts)
+        # [number of contexts left, if the context is parked]
+        waiting = [len(contexts), False]
+
+        def on_result(index: int, result):
+            results[index] = result
+            waiting[0] -= 1
+            if waiting[0] == 0 and waiting[1]:
+                waiting[1] = False
+                context.resume(results)
+
+        def on_exception(exception: BaseException):
+            waiting[0] = -1
+            if waiting[1]:
+                waiting[1] = False
+                context.resume_exception(exception)
+
+        def on_cancel():
+            # Cancel everything we were waiting on, too.
+            waiting[1] = False
+            for ctx in contexts:
+                ctx.cancel()
+
+        for index, ctx in enumerate(contexts):
+            if ctx.state is VSCtxState.FINISHED:
+                on_result(index, ctx.result)
+            elif ctx.state is VSCtxState.ERRORED:
+                raise ctx._exception_state
+            else:
+                ctx.add_done_callback(functools.partial(on_result, index))
+                ctx.add_exception_callback(on_exception)
+
+        if waiting[0] == 0:
+            # Everything has completed already.
+            return results
+
+        waiting[1] = True
+        context.suspend(on_cancel)
+
+    @native_invoke
+    def wait_for(self, context: _VSContext, other: _VSContext, timeout: float):
+        """
+        Parks a context until another context has completed, or a timeout runs out.
+
+        The other context must already be running, or be spawned.
+        If the timeout runs out first, the other context is cancelled, and the context is resumed with a
+        TimeoutError.
+
+        :param context: The context to park.
+        :param other: The context to wait on.
+        :param timeout: The most seconds to wait for.
+        :return: The result of the other context, if it has already completed.
+        """
+        if other.state is VSCtxState.FINISHED:
+            return other.result
+        elif other.state is VSCtxState.ERRORED:
+            raise other._exception_state
+
+        # [if the context is parked]
+        waiting = [True]
+
+        def on_result(result):
+            if waiting[0]:
+                waiting[0] = False
+                handle.cancel()
+                context.resume(result)
+
+        def on_exception(exception: BaseException):
+            if waiting[0]:
+                waiting[0] = False
+                handle.cancel()
+                context.resume_exception(exception)
+
+        def on_timeout():
+            waiting[0] = False
+            other.cancel()
+            context.resume_exception(TimeoutError("Timed out after {} seconds".format(timeout)))
+
+        def on_cancel():
+            waiting[0] = False
+            handle.cancel()
+            other.cancel()
+
+        handle = self.call_later(timeout, on_timeout)
+        other.add_done_callback(on_result)
+        other.add_exception_callback(on_exception)
+        context.suspend(on_cancel)
+
+    @native_invoke
+    def enable_metrics(self) -> LoopMetrics:
+        """
+        Starts counting metrics for this loop and its engine.
+
+        :return: The loop's metrics, which are updated in place.
+        """
+        if self.metrics is None:
+            self.metrics = LoopMetrics()
+
+        self.bytecode_engine.enable_metrics()
+        return self.metrics
+
+    @native_invoke
+    def disable_metrics(self):
+        """
+        Stops counting metrics for this loop and its engine.
+        """
+        self.metrics = None
+        self._stats_dump = None
+        self.bytecode_engine.disable_metrics()
+
+    @native_invoke
+    def stats(self) -> dict:
+        """
+        Takes a snapshot of the loop's state.
+
+        The queue sizes are always included; the counters and timings are only included if metrics are enabled.
+
+        :return: A dict of plain values, which can be serialized as JSON.
+        """
+        stats = {
+            "time": self.time(),
+            "ready": len(self.running_tasks),
+            "suspended": len(self.suspended_tasks),
+            "timers": len(self._timers),
+            "executor_jobs": self._executor_jobs,
+            "executor_backlog": len(self._executor_backlog),
+        }
+
+        if self.metrics is not None:
+            stats["loop"] = self.metrics.snapshot()
+        if self.bytecode_engine.metrics is not None:
+            stats["engine"] = self.bytecode_engine.metrics.snapshot()
+
+        return stats
+
+    @native_invoke
+    def dump_stats_periodically(self, path: str, interval: float = 1.0):
+        """
+        Appends a snapshot from `stats` to a file every `interval` seconds while the loop is running, as a line of
+        JSON.
+
+        This enables metrics, if they're not enabled already. It doesn't keep the loop running on its own.
+
+        :param path: The file to append to, or None to stop dumping.
+        """
+        if path is None:
+            self._stats_dump = None
+            return
+
+        self.enable_metrics()
+        self._stats_dump = [path, interval, self.time() + interval]
+
+    def _dump_stats(self):
+        path, interval, _ = self._stats_dump
+        self._stats_dump[2] = self.time() + interval
+        with open(path, "a") as f:
+            f.write(json.dumps(self.stats()) + "\n")
+
+    @native_invoke
+    def close(self):
+        """
+        Closes the loop.
+        """
+        if self._running:
+            raise RuntimeError("Cannot close a running loop")
+
+        self._closed = True
+        self.selector.close()
+
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
 
 def create_event_loop(**kwargs):
     return BaseAsyncLoop(**kwargs)
 
 
 def set_event_loop(loop: BaseAsyncLoop):
-    LoopLocal.loop = loop
+    _local.loop = loop
 
 
 def get_event_loop():
-    if LoopLocal.loop:
-        return LoopLocal.loop
+    if _local.loop:
+        return _local.loop
 
     set_event_loop(create_event_loop())
-    return LoopLocal.loop
+    return _local.loop
+
+
+def get_running_loop() -> BaseAsyncLoop:
+    """
+    :return: The loop that is currently running on this thread.
+    """
+    if _local.running_loop is None:
+        raise RuntimeError("No loop is running")
+
+    return _local.running_loop
+
+
+@suspending
+def wait_readable(ctx: _VSContext, fileobj):
+    """
+    Parks the calling context until a file object is readable.
+    """
+    get_running_loop().wait_io(ctx, fileobj, selectors.EVENT_READ)
+
+
+@suspending
+def wait_writable(ctx: _VSContext, fileobj):
+    """
+    Parks the calling context until a file object is writable.
+    """
+    get_running_loop().wait_io(ctx, fileobj, selectors.EVENT_WRITE)
+
+
+@suspending
+def sleep(ctx: _VSContext, seconds: float, result=None):
+    """
+    Parks the calling context for a number of seconds.
+
+    :param seconds: The number of seconds to sleep for.
+    :param result: The value to return when the context wakes up.
+    """
+    handle = get_running_loop().call_later(seconds, ctx.resume, result)
+    ctx.suspend(handle.cancel)
+
+
+@suspending
+def run_in_executor(ctx: _VSContext, fn: callable, *args):
+    """
+    Runs a blocking function in the running loop's executor, and parks the calling context until it's done.
+
+    :param fn: The function to run. This runs natively, in another thread (or process).
+    :return: The return value of the function.
+    """
+    get_running_loop().run_in_executor(ctx, fn, *args)
+
+
+@native_invoke
+def spawn(function, *args) -> _VSContext:
+    """
+    Schedules a function to run concurrently on the running loop.
+
+    From inside VS, calling a function runs it straight away, so pass the function and its arguments here instead.
+
+    :param function: A context, or a function to create a new context for with `args`.
+    :return: The new context.
+    """
+    return get_running_loop().spawn(function, *args)
+
+
+@suspending
+def gather(ctx: _VSContext, *contexts: _VSContext):
+    """
+    Parks the calling context until a number of spawned contexts have completed.
+
+    :return: A list of the result of each context.
+    """
+    return get_running_loop().gather(ctx, *contexts)
+
+
+@suspending
+def wait_for(ctx: _VSContext, context: _VSContext, timeout: float):
+    """
+    Parks the calling context until a spawned context has completed, or a timeout runs out.
+
+    If the timeout runs out first, the spawned context is cancelled and TimeoutError is raised.
+
+    :return: The result of the spawned context.
+    """
+    return get_running_loop().wait_for(ctx, context, timeout)
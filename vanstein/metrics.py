@@ -0,0 +1,126 @@
+"""
+Metrics for the event loop and the bytecode engine.
+
+Metrics are disabled by default. When they're disabled, the engine and the loop run exactly the same code as they
+would without them; enabling them switches to counting versions of the hot paths.
+"""
+import time
+
+# The clock used for every timing.
+clock = time.perf_counter
+
+
+class Histogram(object):
+    """
+    A histogram of durations, with power-of-two buckets in microseconds.
+
+    Bucket `n` counts the durations of up to `2 ** n` microseconds; the last bucket counts everything longer.
+    """
+
+    BUCKETS = 32
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * self.BUCKETS
+
+    def __repr__(self):
+        return "<Histogram count={} mean={:.6f} max={:.6f}>".format(self.count, self.mean, self.max)
+
+    def record(self, seconds: float):
+        """
+        Records a duration.
+        """
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+        micros = int(seconds * 1000000)
+        self.buckets[min(micros.bit_length(), self.BUCKETS - 1)] += 1
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, percent: float) -> float:
+        """
+        :return: The upper bound of the bucket the percentile falls in, in seconds.
+            This is never more than the largest duration recorded.
+        """
+        if not self.count:
+            return 0.0
+
+        wanted = self.count * percent / 100
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= wanted:
+                return min((2 ** bucket) / 1000000, self.max)
+
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+        }
+
+
+class EngineMetrics(object):
+    """
+    Counters for a :class:`vanstein.interpreter.engine.VansteinEngine`.
+    """
+
+    def __init__(self):
+        # The number of bytecode instructions ran.
+        self.instructions = 0
+
+        # The number of times the engine started running a context.
+        self.context_switches = 0
+
+        # The number of calls made by CALL_FUNCTION, by kind.
+        self.native_calls = 0
+        self.suspending_calls = 0
+        self.vs_calls = 0
+
+        # The number of contexts created, by VS calls or by spawning them on the loop, and the number that finished or
+        # errored.
+        self.contexts_created = 0
+        self.contexts_finished = 0
+        self.contexts_errored = 0
+
+        # The number of exceptions raised inside contexts, whether by an instruction, a native call, `resume_exception`
+        # or `cancel`.
+        self.exceptions_injected = 0
+
+    def snapshot(self) -> dict:
+        return dict(self.__dict__)
+
+
+class LoopMetrics(object):
+    """
+    Counters and timings for a :class:`vanstein.loop.BaseAsyncLoop`.
+    """
+
+    def __init__(self):
+        # The number of tasks taken off the ready queue.
+        self.steps = 0
+
+        # How long the engine ran each task for, before it switched back to the loop.
+        self.slice_duration = Histogram()
+
+        # How long each task waited on the ready queue before it was ran.
+        self.ready_latency = Histogram()
+
+    def snapshot(self) -> dict:
+        return {
+            "steps": self.steps,
+            "slice_duration": self.slice_duration.snapshot(),
+            "ready_latency": self.ready_latency.snapshot(),
+        }
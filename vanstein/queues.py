@@ -0,0 +1,153 @@
+"""
+Queues, for passing items between contexts.
+"""
+import collections
+import functools
+
+from vanstein.context import _VSContext
+from vanstein.decorators import native_invoke, suspending
+
+
+class Queue(object):
+    """
+    A FIFO queue shared between contexts.
+
+    `get` parks the calling context while the queue is empty, and `put` parks it while the queue is full.
+    Whenever a context is parked on one end, the other end hands items to it directly instead of going through the
+    queue.
+    """
+
+    def __init__(self, maxsize: int = 0):
+        """
+        :param maxsize: The most items the queue can hold before `put` parks.
+            If this is 0, the queue is unbounded.
+        """
+        self.maxsize = maxsize
+
+        self._items = collections.deque()
+
+        # The contexts parked in `get` or `get_many`, with the most items they want.
+        # This is None for `get`, which wants a single item and not a list.
+        # There are only getters when the queue is empty.
+        self._getters = collections.deque()
+
+        # The contexts parked in `put` or `put_many`, with the items they still have to put.
+        # There are only putters when the queue is full.
+        self._putters = collections.deque()
+
+    def __repr__(self):
+        return "<{} maxsize={} size={} getters={} putters={}>".format(
+            type(self).__name__, self.maxsize, len(self._items), len(self._getters), len(self._putters)
+        )
+
+    @native_invoke
+    def qsize(self) -> int:
+        """
+        :return: The number of items in the queue.
+        """
+        return len(self._items)
+
+    @native_invoke
+    def empty(self) -> bool:
+        return not self._items
+
+    @native_invoke
+    def full(self) -> bool:
+        return 0 < self.maxsize <= len(self._items)
+
+    def _hand_to_getter(self, items: collections.deque):
+        # Hand items from the front of `items` to the first parked getter.
+        # If the getter is cancelled before it runs, it gives them back.
+        ctx, count = self._getters.popleft()
+        taken = [items.popleft() for _ in range(1 if count is None else min(count, len(items)))]
+        ctx.resume(taken[0] if count is None else taken, functools.partial(self._return_items, taken))
+
+    def _return_items(self, items: list):
+        # Put items back on the front of the queue, so they're still the next ones to be got.
+        # This can overfill a bounded queue, until they're taken off again.
+        self._items.extendleft(reversed(items))
+        while self._items and self._getters:
+            self._hand_to_getter(self._items)
+
+    def _put_items(self, items: collections.deque):
+        # Move as many items as we can out of `items`, first to parked getters and then into the queue.
+        while items:
+            if self._getters:
+                self._hand_to_getter(items)
+            elif not self.full():
+                self._items.append(items.popleft())
+            else:
+                break
+
+    def _take_items(self, count: int) -> list:
+        # Take up to `count` items off the queue, then refill it from the parked putters.
+        taken = [self._items.popleft() for _ in range(min(count, len(self._items)))]
+
+        while self._putters and not self.full():
+            ctx, items = self._putters[0]
+            self._items.append(items.popleft())
+            if not items:
+                self._putters.popleft()
+                ctx.resume(None)
+
+        return taken
+
+    def _wait_for_items(self, ctx: _VSContext, count: int):
+        entry = (ctx, count)
+        self._getters.append(entry)
+        ctx.suspend(functools.partial(self._getters.remove, entry))
+
+    def _put(self, ctx: _VSContext, items: collections.deque):
+        self._put_items(items)
+        if items:
+            # The queue is full; wait for a getter to make room for the rest.
+            # If we're cancelled, the items that haven't been put yet are dropped.
+            entry = (ctx, items)
+            self._putters.append(entry)
+            ctx.suspend(functools.partial(self._putters.remove, entry))
+
+    @suspending
+    def put(self, ctx: _VSContext, item):
+        """
+        Puts an item on the queue, parking the calling context while the queue is full.
+        """
+        self._put(ctx, collections.deque((item,)))
+
+    @suspending
+    def put_many(self, ctx: _VSContext, items):
+        """
+        Puts several items on the queue, in order.
+
+        This only switches contexts once, rather than once per item.
+        The calling context is parked until every item has been put.
+        """
+        self._put(ctx, collections.deque(items))
+
+    @suspending
+    def get(self, ctx: _VSContext):
+        """
+        Gets an item from the queue, parking the calling context while the queue is empty.
+
+        :return: The item.
+        """
+        if self._items:
+            return self._take_items(1)[0]
+
+        self._wait_for_items(ctx, None)
+
+    @suspending
+    def get_many(self, ctx: _VSContext, max_items: int):
+        """
+        Gets up to `max_items` items from the queue, parking the calling context while the queue is empty.
+
+        This does not wait for the queue to fill up; it returns as soon as there are any items.
+
+        :return: A list of at least one item.
+        """
+        if max_items < 1:
+            raise ValueError("max_items must be at least 1")
+
+        if self._items:
+            return self._take_items(max_items)
+
+        self._wait_for_items(ctx, max_items)
@@ -0,0 +1,284 @@
+"""
+Sharded loops, which run contexts across several worker processes.
+
+Each shard is a process with its own :class:`vanstein.loop.BaseAsyncLoop` and bytecode engine, so CPU-bound VS code
+can use more than one core.
+
+Only top-level calls can be sharded: the function and its arguments are pickled and sent to a shard, and so is its
+result. Functions are pickled by reference, so they must be defined at the top level of a module.
+"""
+import concurrent.futures
+import functools
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import os
+import threading
+
+from vanstein.decorators import async_func, native_invoke
+from vanstein.loop import BaseAsyncLoop, set_event_loop, wait_readable
+
+
+def _picklable_exception(exception: BaseException) -> BaseException:
+    # Exceptions raised inside VS carry a traceback made of contexts, which can't be pickled.
+    # Send a copy without it; if it can't be copied, send a description of it instead.
+    try:
+        copy = type(exception)(*exception.args)
+    except Exception:
+        copy = RuntimeError(repr(exception))
+
+    copy.__cause__ = None
+    return copy
+
+
+class _ShardWorker(object):
+    """
+    The state of a shard, inside its worker process.
+    """
+
+    def __init__(self, conn: multiprocessing.connection.Connection, loop: BaseAsyncLoop):
+        self.conn = conn
+        self.loop = loop
+        self.running = True
+
+    @native_invoke
+    def dispatch(self):
+        """
+        Spawns a context for every job waiting on the connection.
+        """
+        while self.running and self.conn.poll():
+            try:
+                message = self.conn.recv()
+            except EOFError:
+                message = None
+
+            if message is None:
+                # The sharded loop is closing; the contexts that are still running carry on until they're done.
+                self.running = False
+                return
+
+            job_id, function, args = message
+            try:
+                context = self.loop.spawn(function, *args)
+            except BaseException as e:
+                self._send(job_id, False, e)
+                continue
+
+            context.add_done_callback(functools.partial(self._send, job_id, True))
+            context.add_exception_callback(functools.partial(self._send, job_id, False))
+
+    def _send(self, job_id: int, ok: bool, value):
+        if not ok:
+            value = _picklable_exception(value)
+
+        try:
+            self.conn.send((job_id, ok, value))
+        except Exception as e:
+            # The result couldn't be pickled.
+            self.conn.send((job_id, False, _picklable_exception(e)))
+
+
+@async_func
+def _serve(worker: _ShardWorker):
+    while worker.running:
+        wait_readable(worker.conn)
+        worker.dispatch()
+
+
+def _shard_main(conn: multiprocessing.connection.Connection):
+    """
+    The entry point of a shard's worker process.
+    """
+    loop = BaseAsyncLoop()
+    set_event_loop(loop)
+    loop.run(_serve(_ShardWorker(conn, loop)))
+    loop.close()
+    conn.close()
+
+
+class ShardedLoop(object):
+    """
+    Runs top-level VS calls across a number of worker processes.
+
+    Each call is sent to the shard with the fewest calls still running on it.
+
+    Example usage:
+    .. code:: python
+
+        with ShardedLoop() as loop:
+            results = loop.gather(*[loop.submit(crunch, chunk) for chunk in chunks])
+    """
+
+    def __init__(self, shards: int = None):
+        """
+        :param shards: The number of worker processes to start. None uses the number of CPUs.
+        """
+        self.shard_count = shards or os.cpu_count() or 1
+
+        self._closed = False
+
+        # The parent's end of the pipe to each shard, and a lock for sending on it.
+        self._conns = []
+        self._send_locks = []
+        self._processes = []
+
+        # The number of calls still running on each shard.
+        self._outstanding = [0] * self.shard_count
+
+        # The shards whose process has gone away; nothing is sent to these any more.
+        self._dead = set()
+
+        # The futures for calls that haven't completed yet; {job id: (shard, future)}.
+        self._jobs = {}
+        self._job_ids = itertools.count()
+        self._lock = threading.Lock()
+
+        for _ in range(self.shard_count):
+            conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_shard_main, args=(child_conn,), daemon=True)
+            process.start()
+            child_conn.close()
+
+            self._conns.append(conn)
+            self._send_locks.append(threading.Lock())
+            self._processes.append(process)
+
+        # The results are received in a background thread, so that submitting never waits on them.
+        self._receiver = threading.Thread(target=self._receive, name="vanstein-shard-receiver", daemon=True)
+        self._receiver.start()
+
+    def __repr__(self):
+        return "<ShardedLoop shards={} outstanding={} dead={}>".format(self.shard_count, self._outstanding,
+                                                                         len(self._dead))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def submit(self, function, *args) -> concurrent.futures.Future:
+        """
+        Runs a VS function on the least loaded shard.
+
+        Shards that have exited are skipped; if every shard has exited, this raises RuntimeError.
+
+        :param function: The function to run. This and its arguments must be picklable.
+        :return: A `concurrent.futures.Future` for the result.
+        """
+        if self._closed:
+            raise RuntimeError("Loop is closed")
+
+        while True:
+            future = concurrent.futures.Future()
+            with self._lock:
+                live = [shard for shard in range(self.shard_count) if shard not in self._dead]
+                if not live:
+                    raise RuntimeError("Every shard has exited")
+
+                shard = min(live, key=self._outstanding.__getitem__)
+                job_id = next(self._job_ids)
+                self._outstanding[shard] += 1
+                self._jobs[job_id] = (shard, future)
+
+            try:
+                with self._send_locks[shard]:
+                    self._conns[shard].send((job_id, function, args))
+            except OSError:
+                # The shard has exited; try another one.
+                # If the receiver noticed first, it has already failed the job, and the future is thrown away.
+                self._complete(job_id)
+                with self._lock:
+                    self._dead.add(shard)
+            except BaseException:
+                self._complete(job_id)
+                raise
+            else:
+                return future
+
+    def run(self, function, *args):
+        """
+        Runs a VS function on the least loaded shard, and waits for its result.
+
+        :return: The result of the function.
+            If the function raised an exception, it is raised instead.
+        """
+        return self.submit(function, *args).result()
+
+    def gather(self, *futures: concurrent.futures.Future) -> list:
+        """
+        Waits for a number of calls made with `submit`.
+
+        :return: A list of the result of each call.
+            If any call raised an exception, the first one is raised instead.
+        """
+        return [future.result() for future in futures]
+
+    def _complete(self, job_id: int) -> concurrent.futures.Future:
+        """
+        :return: The future for a job, or None if the job has already been completed or failed.
+        """
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+            if job is None:
+                return None
+
+            shard, future = job
+            self._outstanding[shard] -= 1
+
+        return future
+
+    def _receive(self):
+        conns = list(self._conns)
+        while conns:
+            for conn in multiprocessing.connection.wait(conns):
+                try:
+                    job_id, ok, value = conn.recv()
+                except (EOFError, OSError):
+                    conns.remove(conn)
+                    self._fail_shard(self._conns.index(conn))
+                    continue
+
+                future = self._complete(job_id)
+                if future is None:
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    def _fail_shard(self, shard: int):
+        # The shard has gone away, so nothing still running on it is ever going to complete.
+        # The jobs are taken off in one go, so that `submit` can't complete any of them at the same time.
+        with self._lock:
+            self._dead.add(shard)
+            lost = [job_id for job_id, (job_shard, _) in self._jobs.items() if job_shard == shard]
+            futures = [self._jobs.pop(job_id)[1] for job_id in lost]
+            self._outstanding[shard] = 0
+
+        for future in futures:
+            future.set_exception(RuntimeError("Shard {} exited".format(shard)))
+
+    def close(self):
+        """
+        Closes the loop.
+
+        Every shard finishes the calls it is running, then exits.
+        """
+        if self._closed:
+            return
+
+        self._closed = True
+        for conn, lock in zip(self._conns, self._send_locks):
+            with lock:
+                try:
+                    conn.send(None)
+                except OSError:
+                    pass
+
+        for process in self._processes:
+            process.join()
+
+        self._receiver.join()
+        for conn in self._conns:
+            conn.close()